@@ -1,11 +1,12 @@
 import streamlit as st
 import scraper
-import importlib
+import context
+import discovery
+import jobstore
+import metrics
 import prompts
-importlib.reload(prompts) # モジュールの変更を強制的に反映
+from postprocess import clean_html_tags, parse_generated_content, compose_generated_content, extract_fields, IncrementalSectionParser
 import os
-import re
-import json
 from datetime import datetime
 
 # ページ設定
@@ -15,6 +16,31 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def prepare_result(raw_text):
+    """
+    生成結果をパースし、属性を削除したHTMLと型付きの値（タイトル・レビュー等）、処理時間（ミリ秒）を返す
+
+    ウィジェットを操作するたびにスクリプト全体が再実行されるため、同じ生成結果ならキャッシュを使う
+    （計測の区間もキャッシュしていない初回だけ記録する）
+    """
+    with metrics.span("parse") as parse_span:
+        parsed = parse_generated_content(raw_text)
+        if "error" in parsed:
+            html, fields = "", None
+        else:
+            # 強制的にタグの属性を削除（見出し等のスタイル混入防止）
+            html = clean_html_tags(parsed.get("html_content", ""))
+            fields = extract_fields(parsed)
+    return parsed, html, fields, parse_span["duration_ms"]
+
+@st.cache_data(ttl=60, show_spinner=False)
+def recent_products():
+    """
+    保存済みの生成結果の商品名（新しい順）。生成結果を保存したときは recent_products.clear() で破棄する
+    """
+    return jobstore.get_job_store().recent()
+
 # タイトルと説明
 st.title("医薬品商品詳細ページ自動生成ツール")
 st.markdown("""
@@ -45,6 +71,11 @@ else:
         index=0,
         help="HTMLとコンテンツ生成に使用するモデル"
     )
+
+    model_stats = prompts.get_model_stats()
+    if model_stats:
+        with st.expander("モデルの稼働状況"):
+            st.dataframe([{"model": name, **stats} for name, stats in model_stats.items()])
     
 
 
@@ -53,93 +84,168 @@ else:
 
 st.markdown("---")
 
-def clean_html_tags(html_content):
-    """
-    指定されたタグ（h2-h6, table, ul, ol）から属性（style, class等）を強制的に削除する
-    """
-    # 削除対象のタグ
-    target_tags = ["h2", "h3", "h4", "h5", "h6", "table", "ul", "ol"]
-    
-    cleaned_html = html_content
-    for tag in target_tags:
-        # <tag ...> を <tag> に置換 (閉じタグはそのまま)
-        # 属性がある場合のみ置換するための正規表現
-        # 例: <h2 style="..."> -> <h2>
-        pattern = re.compile(f'<{tag}\\s+[^>]*>', re.IGNORECASE)
-        cleaned_html = pattern.sub(f'<{tag}>', cleaned_html)
-        
-    return cleaned_html
-
-def parse_generated_content(text):
-    """
-    生成されたテキストから各セクションを抽出する
-    """
-    # エラーチェック
-    if text.startswith("Error:"):
-        return {"error": text}
-
-    sections = {}
-    
-    # 正規表現でタグの中身を抽出
-    patterns = {
-        "metadata": r"<metadata>(.*?)</metadata>",
-        "html_content": r"<html_content>(.*?)</html_content>",
-        "reviews": r"<reviews>(.*?)</reviews>",
-        "references": r"<references>(.*?)</references>"
-    }
-    
-    for key, pattern in patterns.items():
-        match = re.search(pattern, text, re.DOTALL)
-        if match:
-            sections[key] = match.group(1).strip()
-        else:
-            sections[key] = ""
-            
-    return sections
-
 # メインエリア
 col1, col2 = st.columns([1, 1])
 
 with col1:
     st.subheader("1. 情報入力")
     
-    product_name = st.text_input("商品名", placeholder="例: アナドリン")
+    product_name = st.text_input("商品名", placeholder="例: アナドリン", key="product_name_input")
     
     target_urls = st.text_area(
         "参考にする競合URL (複数可)", 
         height=150, 
-        placeholder="https://example.com/product/a\nhttps://competitor.com/item/b"
+        placeholder="https://example.com/product/a\nhttps://competitor.com/item/b",
+        key="target_urls",
     )
+
+    # サイトマップから作った検索インデックス（python bulk.py discover）があれば、競合URLを自動で探せる
+    if os.path.exists(discovery.DISCOVERY_DB):
+        def fill_competitor_urls():
+            urls = discovery.find_competitor_urls(st.session_state.get("product_name_input", ""))
+            if urls:
+                st.session_state["target_urls"] = "\n".join(urls)
+            else:
+                st.session_state["discovery_miss"] = True
+
+        st.button("🔍 インデックスから競合URLを探す", on_click=fill_competitor_urls, disabled=not product_name)
+        if st.session_state.pop("discovery_miss", False):
+            st.warning("インデックスに一致する商品ページが見つかりませんでした。")
     
     additional_info = st.text_area("特記事項 (任意)", placeholder="例: 成分量は50mgです。配送は1週間程度です。")
 
+    saved_products = recent_products()
+    if saved_products:
+        with st.expander("📂 保存済みの生成結果を開く"):
+            saved_name = st.selectbox("商品名", saved_products)
+            if st.button("この生成結果を表示する"):
+                job = jobstore.get_job_store().find(saved_name)
+                st.session_state['raw_response'] = job["raw_response"]
+                st.session_state['product_name'] = job["product_name"]
+                st.session_state['from_cache'] = True
+                st.session_state['used_model'] = (job["record"] or {}).get("model")
+                st.session_state['timings'] = (job["record"] or {}).get("timings")
+                st.session_state['context_text'] = None
+                st.session_state['source_urls'] = job["product"]["urls"]
+                st.session_state['notes'] = job["product"].get("notes", "")
+
+    token_budget = st.number_input(
+        "参考情報の上限トークン数",
+        min_value=1000,
+        max_value=100000,
+        value=context.DEFAULT_TOKEN_BUDGET,
+        step=1000,
+        help="競合サイトの重複部分を除き、商品名との関連が高い部分からこの上限まで使用します"
+    )
+
+    refresh_cache = st.checkbox("キャッシュを使わずに再生成する", help="同じ入力の生成結果が保存されていても、AIで生成し直します")
+    stream_mode = st.checkbox("生成中のセクションを順次表示する", value=True, help="完成したセクションから右側のタブに表示します")
+    fanout_mode = st.checkbox(
+        "セクションを並列で生成する",
+        help="本文・メタデータ・レビュー・参考リンクを同時に生成します（本文以外は速いモデルを使用）。待ち時間は最も遅いセクション程度になります"
+    )
+    structured_mode = st.checkbox(
+        "構造化出力（JSONスキーマ）で生成する",
+        help="タイトルやレビューを型の決まったJSONで出力させ、形式崩れによる再生成を防ぎます（順次表示・並列生成とは併用できません）"
+    )
+
     if st.button("🚀 ページを生成する", type="primary", disabled=not api_key):
         if not product_name or not target_urls:
             st.error("商品名とURLは必須です。")
         else:
-            with st.status("処理を実行中...", expanded=True) as status:
+            with st.status("処理を実行中...", expanded=True) as status, \
+                    metrics.start_run("app", product=product_name) as run:
                 # 1. スクレイピング
                 st.write("🌐 競合サイトから情報を収集中...")
-                scrape_results = scraper.scrape_multiple_urls(target_urls)
+                scrape_results = scraper.scrape_multiple_urls(target_urls, deadline=30)
                 
-                # コンテキストの作成
-                context_text = ""
                 for res in scrape_results:
                     if "error" in res:
                         st.warning(f"取得失敗: {res['url']} ({res['error']})")
                     else:
                         st.success(f"取得成功: {res['title']}")
-                        context_text += f"\n--- Source: {res['url']} ---\nTitle: {res['title']}\nContent: {res['content']}\n"
-                
-                if additional_info:
-                    context_text += f"\n--- User Note ---\n{additional_info}\n"
+
+                # コンテキストの作成
+                context_text, context_stats = context.build_context(
+                    scrape_results, product_name, additional_info, token_budget=token_budget
+                )
+                st.write(
+                    f"📉 参考情報: 約{context_stats['baseline_tokens']:,} → {context_stats['context_tokens']:,} トークン"
+                    f"（重複 {context_stats['duplicates_removed']} 件・上限超過 {context_stats['dropped_by_budget']} 件を除外）"
+                )
 
                 # 2. AI生成
                 st.write(f"🧠 AI ({text_model}) が構成とコンテンツを生成中 (SEO/AIO対策)...")
-                raw_response = prompts.generate_content(api_key, context_text, product_name, text_model)
+                if (stream_mode or fanout_mode) and not structured_mode:
+                    result = {}
+                    section_parser = IncrementalSectionParser()
+                    # 右側のエリアに、完成したセクションから順に表示する
+                    live_area = col2.empty()
+                    with live_area.container():
+                        st.caption("⏳ 生成中... 完成したセクションから表示しています")
+                        live_tabs = st.tabs(["🖼️ プレビュー", "⚙️ メタデータ", "⭐ レビュー", "🔗 参考リンク"])
+                        slots = {
+                            "html_content": live_tabs[0].empty(),
+                            "metadata": live_tabs[1].empty(),
+                            "reviews": live_tabs[2].empty(),
+                            "references": live_tabs[3].empty(),
+                        }
+                    def show_section(key, value):
+                        with slots[key].container():
+                            if key == "html_content":
+                                st.components.v1.html(clean_html_tags(value), height=600, scrolling=True)
+                            elif key == "reviews":
+                                st.code(value, language="json")
+                            elif key == "references":
+                                st.markdown(value)
+                            else:
+                                st.text(value)
+
+                    if fanout_mode:
+                        result = prompts.generate_content_fanout(
+                            api_key, context_text, product_name, text_model, refresh=refresh_cache,
+                            on_section=show_section,
+                        )
+                    else:
+                        for chunk in prompts.generate_content_stream(
+                            api_key, context_text, product_name, text_model, refresh=refresh_cache, info=result
+                        ):
+                            for key, value in section_parser.feed(chunk):
+                                show_section(key, value)
+                        result["text"] = section_parser.buffer
+                    live_area.empty()
+                else:
+                    result = prompts.generate_content_detailed(
+                        api_key, context_text, product_name, text_model, refresh=refresh_cache,
+                        structured=structured_mode,
+                    )
                 
-                st.session_state['raw_response'] = raw_response
+                st.session_state['raw_response'] = result["text"]
                 st.session_state['product_name'] = product_name
+                st.session_state['from_cache'] = result["cached"]
+                st.session_state['used_model'] = result["model"]
+                st.session_state['timings'] = run.summary()
+                st.session_state['context_text'] = context_text
+                st.session_state['source_urls'] = target_urls.split()
+                st.session_state['notes'] = additional_info
+
+                # ブラウザの再読み込みや再起動で失われないよう、生成結果をジョブストアに保存する
+                # （途中で中断されたストリーミングの出力は不完全なため保存しない）
+                if result.get("error"):
+                    st.error(f"生成結果は保存されていません: {result['error']}")
+                elif not result["text"].startswith("Error:"):
+                    jobstore.get_job_store().save(
+                        {"product_name": product_name, "urls": target_urls.split(), "notes": additional_info},
+                        {
+                            "product_name": product_name,
+                            "model": result["model"],
+                            "usage": result.get("usage", {}),
+                            "context_stats": context_stats,
+                            "timings": st.session_state['timings'],
+                            "raw_response": result["text"],
+                        },
+                    )
+                    recent_products.clear()
                 
                 status.update(label="完了!", state="complete", expanded=False)
 
@@ -148,18 +254,65 @@ with col2:
     
     if 'raw_response' in st.session_state:
         raw_text = st.session_state['raw_response']
-        parsed_data = parse_generated_content(raw_text)
+        if st.session_state.get('from_cache'):
+            st.caption(f"♻️ キャッシュ済みの生成結果を表示しています（モデル: {st.session_state.get('used_model')}）")
+        elif st.session_state.get('used_model'):
+            st.caption(f"🆕 新規に生成しました（モデル: {st.session_state.get('used_model')}）")
+        parsed_data, html_content, fields, parse_ms = prepare_result(raw_text)
         
         # エラー判定
         if "error" in parsed_data:
             st.error(parsed_data["error"])
         else:
+            # 1つのセクションだけを再生成して差し替える（他のセクションはそのまま）
+            section_labels = {
+                "html_content": "🖼️ 本文HTML",
+                "metadata": "⚙️ メタデータ",
+                "reviews": "⭐ レビュー",
+                "references": "🔗 参考リンク",
+            }
+            regen_col, regen_button_col = st.columns([3, 1])
+            target_section = regen_col.selectbox(
+                "再生成するセクション", list(section_labels), format_func=section_labels.get,
+                label_visibility="collapsed",
+            )
+            if regen_button_col.button("🔁 このセクションだけ再生成", disabled=not api_key):
+                with st.spinner(f"{section_labels[target_section]} を再生成中..."):
+                    section_context = st.session_state.get('context_text')
+                    if section_context is None:
+                        # 保存済みの結果を開いた場合は、保存されている入力から参考情報を作り直す
+                        section_context, _ = context.build_context(
+                            scraper.scrape_multiple_urls(st.session_state.get('source_urls', []), deadline=30),
+                            st.session_state['product_name'], st.session_state.get('notes', ''),
+                            token_budget=token_budget,
+                        )
+                        st.session_state['context_text'] = section_context
+                    section_result = prompts.generate_section(
+                        api_key, section_context, st.session_state['product_name'], target_section, text_model,
+                        current_sections=parsed_data, refresh=True,
+                    )
+                if section_result["text"].startswith("Error:"):
+                    st.error(section_result["text"])
+                else:
+                    section_value = section_result["text"]
+                    if target_section == "html_content":
+                        section_value = clean_html_tags(section_value)
+                    st.session_state['raw_response'] = compose_generated_content({**parsed_data, target_section: section_value})
+                    st.session_state['used_model'] = section_result["model"]
+                    st.session_state['from_cache'] = False
+                    saved_job = jobstore.get_job_store().find(st.session_state['product_name'])
+                    if saved_job and saved_job["state"] == "done":
+                        jobstore.get_job_store().update_section(st.session_state['product_name'], target_section, section_value)
+                    st.rerun()
+
             # タブで表示切り替え
             tab1, tab2, tab3, tab4, tab5 = st.tabs(["🖼️ プレビュー", "📝 HTML", "⚙️ メタデータ", "⭐ レビュー", "🔗 参考リンク"])
             
-            html_content = parsed_data.get("html_content", "")
-            # 強制的にタグの属性を削除（見出し等のスタイル混入防止）
-            html_content = clean_html_tags(html_content)
+            if st.session_state.get('timings'):
+                with st.expander("⏱️ 処理時間の内訳"):
+                    timings = dict(st.session_state['timings'])
+                    timings["parse"] = {"count": 1, "total_ms": parse_ms}
+                    st.dataframe([{"stage": name, **values} for name, values in timings.items()])
             
             with tab1:
                 st.caption("※スタイルは簡易的なものです。")
@@ -189,14 +342,9 @@ with col2:
             with tab3:
                 metadata_text = parsed_data.get("metadata", "")
                 
-                # タイトルとディスクリプション、H1を抽出
-                title_match = re.search(r"Recommended Title:\s*(.*)", metadata_text)
-                h1_match = re.search(r"Recommended H1:\s*(.*)", metadata_text)
-                desc_match = re.search(r"Recommended Description:\s*(.*)", metadata_text)
-                
-                rec_title = title_match.group(1).strip() if title_match else ""
-                rec_h1 = h1_match.group(1).strip() if h1_match else ""
-                rec_desc = desc_match.group(1).strip() if desc_match else ""
+                rec_title = fields["title"]
+                rec_h1 = fields["h1"]
+                rec_desc = fields["description"]
 
                 st.subheader("推奨タイトル")
                 st.code(rec_title, language=None)
@@ -212,16 +360,12 @@ with col2:
                 st.caption("以下のプロンプトを他の画像生成ツール（Midjourney、DALL-E3など）で使用してください。")
 
                 st.caption("🎨 抽象イメージ (効果・悩み解決)")
-                # プロンプト抽出はしていないので、metadata全体から参照するか、ユーザーにRawデータを見てもらう
-                # ここでは簡易的に正規表現で再抽出する
-                img_abstract_match = re.search(r"(?:-|\*)\s*(?:\*\*)?\[Abstract\](?:\*\*)?:?\s*(.*)", metadata_text, re.IGNORECASE)
-                if img_abstract_match:
-                    st.code(img_abstract_match.group(1).strip(), language=None)
+                if fields["image_abstract"]:
+                    st.code(fields["image_abstract"], language=None)
 
                 st.caption("😊 人物イメージ (信頼感・笑顔)")
-                img_person_match = re.search(r"(?:-|\*)\s*(?:\*\*)?\[Person\](?:\*\*)?:?\s*(.*)", metadata_text, re.IGNORECASE)
-                if img_person_match:
-                    st.code(img_person_match.group(1).strip(), language=None)
+                if fields["image_person"]:
+                    st.code(fields["image_person"], language=None)
                 
                 with st.expander("全てのメタデータ & 生データ"):
                     st.text_area("Raw Metadata", metadata_text, height=200)
@@ -231,16 +375,14 @@ with col2:
                 st.caption("生成されたJSONデータ")
                 st.code(reviews_text, language="json")
                 
-                # JSONパースを試みる
-                try:
-                    reviews_json = json.loads(reviews_text)
+                if fields["reviews"] is not None:
                     st.markdown("#### レビュープレビュー")
-                    for rev in reviews_json:
+                    for rev in fields["reviews"]:
                         with st.expander(f"{rev.get('rating', '5')}⭐ {rev.get('title', 'No Title')} ({rev.get('name', 'Anonymous')})"):
                             st.write(rev.get('body', ''))
                             st.caption(f"日付: {rev.get('date', '')}")
-                except:
-                    st.warning("レビューデータのJSONパースに失敗しました（形式が崩れている可能性があります）。")
+                else:
+                    st.warning("レビューデータのJSONパースに失敗しました（形式が崩れている可能性があります）。上の「このセクションだけ再生成」でレビューだけを作り直せます。")
             
             with tab5:
                 ref_text = parsed_data.get("references", "")
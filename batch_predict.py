@@ -0,0 +1,267 @@
+"""
+バッチ予測（オフラインの一括生成）
+
+多数の商品のプロンプトを共通の SYSTEM_INSTRUCTION と共に1つのバッチファイル（JSONL）にまとめて
+プロバイダのバッチ処理に投入し、完了までポーリングして結果を商品ごとに返す。
+対話的な応答速度が要らない夜間のカタログ更新向けで、1件ずつ同期的に呼び出すより
+クォータ・料金あたりの処理量が大きい（Gemini のバッチ処理は通常の半額）。
+
+    requests = (batch_predict.build_request(key, context_text, product_name) for ...)
+    batch_predict.write_batch_file(requests, path)
+    for key, result in batch_predict.run(GeminiBatchTransport(api_key), path, model):
+        ...
+
+- 送信先（トランスポート）は差し替えられる。GeminiBatchTransport は Gemini API の Batch API、
+  LocalBatchTransport は各リクエストをその場で generate_content に送る代替（スタブサーバーでの確認用）
+- 投入したジョブの名前はマニフェスト（<バッチファイル>.json）に保存するので、
+  ポーリング中にプロセスが終了しても attach で続きから結果を受け取れる
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import prompts
+from postprocess import RESPONSE_SCHEMA
+
+BATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "batches")
+
+# ポーリング間隔（秒）。最初は短く、徐々に POLL_MAX まで延ばす
+POLL_INTERVAL = 30.0
+POLL_MAX = 300.0
+# Gemini のバッチは最大24時間で期限切れになる
+POLL_TIMEOUT = 24 * 3600
+
+# バッチジョブの状態（トランスポートはこのいずれかを返す）
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+def build_request(key, context_text, product_name, structured=False):
+    """
+    1商品分のバッチリクエスト（バッチファイルの1行）を作成する
+    """
+    config = {}
+    if structured:
+        system_instruction = prompts.build_structured_instruction()
+        config = {"response_mime_type": "application/json", "response_json_schema": RESPONSE_SCHEMA}
+    else:
+        system_instruction = prompts.SYSTEM_INSTRUCTION
+    request = {
+        "contents": [{"role": "user", "parts": [{"text": prompts.build_user_prompt(context_text, product_name)}]}],
+        "system_instruction": {"parts": [{"text": system_instruction}]},
+    }
+    if config:
+        request["generation_config"] = config
+    return {"key": str(key), "request": request}
+
+def write_batch_file(requests, path):
+    """
+    リクエストを1行ずつバッチファイルに書き出し、件数を返す
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def _field(data, snake):
+    """
+    snake_case / camelCase のどちらのキーでも値を取り出す（SDK と REST でキーの形式が異なる）
+    """
+    if snake in data:
+        return data[snake]
+    head, *rest = snake.split("_")
+    return data.get(head + "".join(word.title() for word in rest))
+
+def parse_result(line):
+    """
+    結果ファイルの1行を (key, {"text", "usage"} または {"error"}) に変換する
+    """
+    key = line.get("key")
+    if line.get("error"):
+        return key, {"error": json.dumps(line["error"], ensure_ascii=False)}
+    response = line.get("response") or {}
+    candidates = response.get("candidates") or []
+    parts = (_field(candidates[0], "content") or {}).get("parts", []) if candidates else []
+    text = "".join(part.get("text", "") for part in parts if not part.get("thought"))
+    if not text:
+        reason = _field(candidates[0], "finish_reason") if candidates else _field(response, "prompt_feedback")
+        return key, {"error": f"Empty response ({reason})"}
+    usage = _field(response, "usage_metadata") or {}
+    return key, {
+        "text": text,
+        "usage": {
+            "prompt_tokens": _field(usage, "prompt_token_count") or 0,
+            "response_tokens": _field(usage, "candidates_token_count") or 0,
+        },
+    }
+
+class GeminiBatchTransport:
+    """
+    Gemini API の Batch API（ファイルをアップロードして投入し、結果ファイルをダウンロードする）
+    """
+    name = "gemini"
+
+    def __init__(self, api_key):
+        self.client = prompts.get_client(api_key)
+
+    def submit(self, path, model, display_name=None):
+        from google.genai import types
+
+        uploaded = self.client.files.upload(
+            file=path,
+            config=types.UploadFileConfig(display_name=display_name or os.path.basename(path), mime_type="jsonl"),
+        )
+        job = self.client.batches.create(
+            model=model, src=uploaded.name, config=types.CreateBatchJobConfig(display_name=display_name),
+        )
+        return job.name
+
+    def poll(self, job_name):
+        job = self.client.batches.get(name=job_name)
+        state = job.state.name if job.state else ""
+        if state in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            return SUCCEEDED, None
+        if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            return FAILED, str(job.error or state)
+        return RUNNING, None
+
+    def download(self, job_name, destination):
+        job = self.client.batches.get(name=job_name)
+        self.client.files.download(file=job.dest.file_name, destination=destination)
+
+class LocalBatchTransport:
+    """
+    バッチファイルの各リクエストをその場で generate_content に送る代替のトランスポート
+
+    prompts.API_BASE_URL をスタブサーバーに向けると、APIキー無しでバッチの流れ全体を確認できる。
+    結果ファイルは Batch API と同じ形式（1行1件の {"key", "response"} / {"key", "error"}）で書き出す
+    """
+    name = "local"
+
+    def __init__(self, api_key, max_workers=4):
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, path, model, display_name=None):
+        job_name = f"local/{os.path.basename(path)}/{time.time():.0f}"
+        results_path = path + ".local-results.jsonl"
+        thread = threading.Thread(target=self._process, args=(job_name, path, model, results_path), daemon=True)
+        with self._lock:
+            self._jobs[job_name] = {"state": RUNNING, "error": None, "results": results_path}
+        thread.start()
+        return job_name
+
+    def _process(self, job_name, path, model, results_path):
+        client = prompts.get_client(self.api_key)
+
+        def call(line):
+            item = json.loads(line)
+            request = item["request"]
+            config = dict(request.get("generation_config") or {})
+            config["system_instruction"] = request["system_instruction"]["parts"][0]["text"]
+            try:
+                response = client.models.generate_content(model=model, contents=request["contents"], config=config)
+                return {"key": item["key"], "response": response.model_dump(mode="json", exclude_none=True)}
+            except Exception as e:
+                return {"key": item["key"], "error": {"message": str(e)}}
+
+        try:
+            with open(path, encoding="utf-8") as src, open(results_path, "w", encoding="utf-8") as out, \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for result in executor.map(call, (line for line in src if line.strip())):
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            state, error = SUCCEEDED, None
+        except Exception as e:
+            state, error = FAILED, str(e)
+        with self._lock:
+            self._jobs[job_name].update(state=state, error=error)
+
+    def poll(self, job_name):
+        with self._lock:
+            job = self._jobs.get(job_name)
+        if job is None:
+            # 別のプロセスで投入したジョブ（処理はそのプロセスと共に終了している）
+            return FAILED, "local batch job is not running in this process"
+        return job["state"], job["error"]
+
+    def download(self, job_name, destination):
+        with self._lock:
+            results_path = self._jobs[job_name]["results"]
+        os.replace(results_path, destination)
+
+TRANSPORTS = {
+    "gemini": GeminiBatchTransport,
+    "local": LocalBatchTransport,
+}
+
+def manifest_path(batch_path):
+    return batch_path + ".json"
+
+def submit(transport, batch_path, model, extra=None):
+    """
+    バッチファイルを投入し、ジョブ名などをマニフェストに保存して返す
+
+    extra にはバッチ外で必要な情報（商品ごとの下書きレコードなど）を入れておく
+    """
+    manifest = {
+        "job_name": transport.submit(batch_path, model, display_name=os.path.basename(batch_path)),
+        "transport": transport.name,
+        "model": model,
+        "batch_path": batch_path,
+        "submitted_at": time.time(),
+        **(extra or {}),
+    }
+    with open(manifest_path(batch_path), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    return manifest
+
+def load_manifest(path):
+    if not path.endswith(".json"):
+        path = manifest_path(path)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def wait(transport, job_name, interval=POLL_INTERVAL, timeout=POLL_TIMEOUT, on_poll=None):
+    """
+    バッチジョブの完了を待つ（間隔は POLL_MAX まで徐々に延ばす）。失敗したら RuntimeError
+    """
+    started = time.time()
+    while True:
+        state, error = transport.poll(job_name)
+        if on_poll:
+            on_poll(state, time.time() - started)
+        if state == SUCCEEDED:
+            return
+        if state == FAILED:
+            raise RuntimeError(f"batch job {job_name} failed: {error}")
+        if time.time() - started + interval > timeout:
+            raise TimeoutError(f"batch job {job_name} did not finish in {timeout}s")
+        time.sleep(interval)
+        interval = min(POLL_MAX, interval * 1.5)
+
+def iter_results(transport, manifest):
+    """
+    完了したバッチの結果をダウンロードし、(key, 結果) を1件ずつ返す
+    """
+    results_path = manifest["batch_path"] + ".results.jsonl"
+    if not os.path.exists(results_path):
+        transport.download(manifest["job_name"], results_path)
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield parse_result(json.loads(line))
+
+def run(transport, batch_path, model, extra=None, interval=POLL_INTERVAL, on_poll=None):
+    """
+    バッチファイルを投入して完了を待ち、(key, 結果) を1件ずつ返す
+    """
+    manifest = submit(transport, batch_path, model, extra)
+    wait(transport, manifest["job_name"], interval=interval, on_poll=on_poll)
+    yield from iter_results(transport, manifest)
@@ -0,0 +1,103 @@
+"""
+clean_html_tags のマイクロベンチマーク
+
+旧実装（タグごとに正規表現をコンパイルして8回走査）と現在の1回走査の実装の速度を、
+生成結果を模した大きなHTMLで比較する。出力は期待する結果（BLOCKS）と照合する
+（旧実装は引用符で囲まれた値の中の ">" でタグを途中で切ってしまうため、照合には使わない）。
+
+使い方:
+    python benchmarks/bench_clean_html.py --sections 30 --large-sections 2000
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postprocess import clean_html_tags
+
+def legacy_clean_html_tags(html_content):
+    """
+    比較用の旧実装
+    """
+    for tag in ["h2", "h3", "h4", "h5", "h6", "table", "ul", "ol"]:
+        pattern = re.compile(f'<{tag}\\s+[^>]*>', re.IGNORECASE)
+        html_content = pattern.sub(f'<{tag}>', html_content)
+    return html_content
+
+# 生成結果に近い構成（見出し・表・リスト・装飾div）のHTMLと、clean_html_tags の期待する出力の組
+BLOCKS = [
+    ('<div style="background-color: #f0f0f0; padding: 10px;"><h2 style="color: #333;">見出し{i}</h2></div>\n',
+     '<div style="background-color: #f0f0f0; padding: 10px;"><h2>見出し{i}</h2></div>\n'),
+    ('<p>本文テキスト<span style="color: #d9534f;">強調</span>が続きます。</p>\n',
+     '<p>本文テキスト<span style="color: #d9534f;">強調</span>が続きます。</p>\n'),
+    ('<h3 class="sub">小見出し</h3>\n', '<h3>小見出し</h3>\n'),
+    ('<table border="1" style="width: 100%;"><tbody><tr><th>成分</th><td>50mg</td></tr></tbody></table>\n',
+     '<table><tbody><tr><th>成分</th><td>50mg</td></tr></tbody></table>\n'),
+    ('<ul class="list"><li>項目A</li><li>項目B</li></ul>\n', '<ul><li>項目A</li><li>項目B</li></ul>\n'),
+    ('<ol><li>手順1</li></ol>\n', '<ol><li>手順1</li></ol>\n'),
+    ('<h4 data-note="a">注意</h4>\n', '<h4>注意</h4>\n'),
+    # 引用符の無い値に "'" が含まれる
+    ("<h5 data-x=it's>補足</h5>\n", "<h5>補足</h5>\n"),
+    # 引用符で囲まれた値に ">" が含まれる
+    ('<h3 title="a>b" class=\'x>y\'>比較</h3>\n', '<h3>比較</h3>\n'),
+    ('<TABLE\n  class="spec"><tr><td>1錠</td></tr></TABLE>\n', '<table><tr><td>1錠</td></tr></TABLE>\n'),
+]
+
+def make_page(sections):
+    """
+    ブロックを sections 回繰り返したHTMLと、期待する出力を返す
+    """
+    html = "".join(raw.format(i=i) for i in range(sections) for raw, _ in BLOCKS)
+    expected = "".join(cleaned.format(i=i) for i in range(sections) for _, cleaned in BLOCKS)
+    return html, expected
+
+def bench(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def compare(page, repeat):
+    html, expected = page
+    assert clean_html_tags(html) == expected, "期待する出力と一致しません"
+    legacy_sec = bench(lambda: legacy_clean_html_tags(html), repeat)
+    current_sec = bench(lambda: clean_html_tags(html), repeat)
+    return {
+        "page_bytes": len(html.encode("utf-8")),
+        "legacy_ms": round(legacy_sec * 1000, 3),
+        "current_ms": round(current_sec * 1000, 3),
+        "speedup": round(legacy_sec / current_sec, 2),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="clean_html_tags のベンチマーク")
+    parser.add_argument("--sections", type=int, default=30, help="通常サイズのページのブロック数")
+    parser.add_argument("--large-sections", type=int, default=2000, help="大きなページのブロック数")
+    parser.add_argument("--pages", type=int, default=1000, help="一括処理を想定したページ数")
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    page = make_page(args.sections)
+    pages = [page[0]] * args.pages
+    legacy_batch = bench(lambda: [legacy_clean_html_tags(p) for p in pages], args.repeat)
+    current_batch = bench(lambda: [clean_html_tags(p) for p in pages], args.repeat)
+
+    print(json.dumps({
+        "benchmark": "clean_html_tags",
+        "page": compare(page, args.repeat),
+        "large_page": compare(make_page(args.large_sections), args.repeat),
+        "batch": {
+            "pages": args.pages,
+            "legacy_pages_per_sec": round(args.pages / legacy_batch, 1),
+            "current_pages_per_sec": round(args.pages / current_batch, 1),
+        },
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
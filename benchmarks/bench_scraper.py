@@ -0,0 +1,165 @@
+"""
+scraper.extract_page のベンチマーク
+
+旧実装（全文ダウンロード + html.parser で全体を解析し、全テキスト抽出後に10000文字で切り捨て）と
+現在の実装（ダウンロード上限 + lxml + 本文エリア検出 + 文字数到達で打ち切り）を比較する。
+各方式は別プロセスで実行し、処理時間とピークメモリ（最大RSS）を計測する。
+
+使い方:
+    python benchmarks/bench_scraper.py --pages-dir saved_pages/   # 保存済みHTML (*.html) を使用
+    python benchmarks/bench_scraper.py --generate 20              # 重いページ・レビューの多いページを生成して使用
+
+生成したページでは、計測の前に商品説明が抽出結果に含まれることを確認する（check_extraction）。
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def legacy_extract_page(html):
+    """
+    比較用の旧実装
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    for script in soup(["script", "style", "nav", "footer", "header"]):
+        script.extract()
+    title = soup.title.string if soup.title else "No Title"
+    text = re.sub(r'\s+', ' ', soup.get_text()).strip()
+    return title, text[:10000]
+
+def make_heavy_page(index):
+    """
+    競合ECサイトを模した重いページ（大量のナビ・スクリプト・関連商品を含む）を作成する
+    """
+    nav = "".join(f'<li><a href="/cat/{i}">カテゴリ{i}</a></li>' for i in range(300))
+    script = "<script>" + "var data = {};" * 5000 + "</script>"
+    body = "".join(
+        f"<h2>見出し{i}</h2><p>{'この医薬品は有効成分を含み、服用方法に注意が必要です。' * 5}</p>"
+        for i in range(60)
+    )
+    related = "".join(
+        f'<div class="item"><img src="/img/{i}.jpg"><p>関連商品{i} 価格 {i * 100}円</p></div>'
+        for i in range(2000)
+    )
+    return (
+        f"<html><head><title>商品{index} | 競合ショップ</title>{script}</head><body>"
+        f"<header>ヘッダー</header><nav><ul>{nav}</ul></nav>"
+        f'<div id="main"><article>{body}</article></div>'
+        f'<div class="related">{related}</div><footer>フッター</footer></body></html>'
+    )
+
+# make_review_page の商品説明（本文エリアの検出でこれが落ちないことを確認する）
+REVIEW_PAGE_DESCRIPTION = "この医薬品は有効成分を含み、1日1回の服用で効果が持続します。"
+
+def make_review_page(index):
+    """
+    商品説明を <div id="main"> に持ち、レビューを1件ずつ <article> に入れたページを作成する
+    """
+    description = "".join(f"<p>{REVIEW_PAGE_DESCRIPTION}（{i}）</p>" for i in range(10))
+    reviews = "".join(
+        f"<article><h3>レビュー{i}</h3><p>{'飲みやすく、副作用もほとんどありませんでした。' * 12}</p></article>"
+        for i in range(5)
+    )
+    return (
+        f"<html><head><title>商品{index} | 競合ショップ</title></head><body>"
+        f'<div id="main"><h1>商品{index}</h1>{description}</div>'
+        f'<section class="reviews">{reviews}</section></body></html>'
+    )
+
+def check_extraction():
+    """
+    ページの形ごとに、抽出結果に商品説明が含まれることを確認する
+    """
+    import scraper
+
+    _, content = scraper.extract_page(make_review_page(0))
+    assert REVIEW_PAGE_DESCRIPTION in content, "レビューの <article> が本文として選ばれ、商品説明が抜けています"
+    _, content = scraper.extract_page(make_heavy_page(0))
+    assert "有効成分" in content and "関連商品" not in content, "本文エリアが検出されていません"
+
+def run_mode(mode, paths):
+    """
+    子プロセスで実行される計測本体
+    """
+    import scraper
+
+    started = time.perf_counter()
+    downloaded = 0
+    chars = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            if mode == "legacy":
+                data = f.read()
+                _, content = legacy_extract_page(data)
+            else:
+                data = f.read(scraper.MAX_DOWNLOAD_BYTES)
+                _, content = scraper.extract_page(data)
+        downloaded += len(data)
+        chars += len(content)
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        "mode": mode,
+        "pages": len(paths),
+        "elapsed_sec": round(elapsed, 4),
+        "ms_per_page": round(elapsed / len(paths) * 1000, 2),
+        "bytes_read": downloaded,
+        "content_chars": chars,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スクレイピング抽出処理のベンチマーク")
+    parser.add_argument("--pages-dir", help="保存済みHTMLのディレクトリ (*.html)")
+    parser.add_argument("--generate", type=int, default=10, help="--pages-dir 未指定時に生成するページ数")
+    parser.add_argument("--mode", choices=["legacy", "current"], help=argparse.SUPPRESS)
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        run_mode(args.mode, args.paths)
+        return
+
+    check_extraction()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.pages_dir:
+            paths = sorted(glob.glob(os.path.join(args.pages_dir, "*.html")))
+        else:
+            paths = []
+            for i in range(args.generate):
+                path = os.path.join(tmp, f"page_{i}.html")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(make_heavy_page(i) if i % 2 == 0 else make_review_page(i))
+                paths.append(path)
+
+        if not paths:
+            parser.error("HTMLファイルが見つかりません")
+
+        results = {}
+        for mode in ("legacy", "current"):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--mode", mode, *paths],
+                check=True, capture_output=True, text=True,
+            )
+            results[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    print(json.dumps({
+        "benchmark": "extract_page",
+        **results,
+        "speedup": round(results["legacy"]["elapsed_sec"] / results["current"]["elapsed_sec"], 2),
+        "rss_saved_kb": results["legacy"]["max_rss_kb"] - results["current"]["max_rss_kb"],
+    }, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+オフラインのエンドツーエンド・ベンチマーク
+
+保存済みの競合ページ（fixtures/pages）をローカルHTTPサーバーで配信し、Gemini API は
+記録済み応答（fixtures/responses）を返すスタブサーバーで置き換えて、APIキー無しで計測する。
+
+計測項目:
+    scrape       : scrape_multiple_urls のスループット（URL/秒）
+    postprocess  : parse_generated_content / clean_html_tags / IncrementalSectionParser の処理速度
+    end_to_end   : bulk.process_product の1商品あたりのレイテンシ（p50/p90/p99）とスループット
+    memory       : エンドツーエンド実行中のピークメモリ（時間の計測とは別の実行で計測する）
+    startup      : アプリが読み込むモジュールの import 時間（新しいプロセスでのコールドスタート）
+
+使い方:
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --failure-rate 0.1 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# パッケージのモジュールを読み込む前に、キャッシュとログの出力先を一時ディレクトリへ向ける
+_WORK_DIR = tempfile.mkdtemp(prefix="lpgen-bench-")
+os.environ["LPGEN_CACHE_DIR"] = os.path.join(_WORK_DIR, "cache")
+os.environ["LPGEN_METRICS"] = "0"
+
+from servers import CorpusServer, FakeGeminiServer  # noqa: E402
+
+import bulk  # noqa: E402
+import cache  # noqa: E402
+import prompts  # noqa: E402
+import ratelimit  # noqa: E402
+import scraper  # noqa: E402
+from postprocess import IncrementalSectionParser, clean_html_tags, parse_generated_content  # noqa: E402
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+def bench_scrape(corpus, rounds):
+    urls = corpus.urls()
+    started = time.perf_counter()
+    errors = 0
+    for _ in range(rounds):
+        results = scraper.scrape_multiple_urls(urls, use_cache=False)
+        errors += sum(1 for r in results if "error" in r)
+    elapsed = time.perf_counter() - started
+    total = len(urls) * rounds
+    return {
+        "urls": total,
+        "errors": errors,
+        "elapsed_sec": round(elapsed, 4),
+        "urls_per_sec": round(total / elapsed, 1),
+        "batch_ms": round(elapsed / rounds * 1000, 2),
+    }
+
+def _per_call_us(func, inputs, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for value in inputs:
+            func(value)
+    return round((time.perf_counter() - started) / (iterations * len(inputs)) * 1e6, 1)
+
+def bench_postprocess(responses, iterations):
+    html_pages = [parse_generated_content(text)["html_content"] for text in responses]
+
+    def incremental(text):
+        parser = IncrementalSectionParser()
+        for i in range(0, len(text), 64):
+            parser.feed(text[i:i + 64])
+
+    return {
+        "parse_us": _per_call_us(parse_generated_content, responses, iterations),
+        "clean_us": _per_call_us(clean_html_tags, html_pages, iterations),
+        "incremental_parse_us": _per_call_us(incremental, responses, iterations),
+    }
+
+def _run_end_to_end(items, workers, on_record=None):
+    cache.get_page_cache().clear()
+    cache.get_response_cache().clear()
+    prompts.circuit_breaker.reset()
+    ratelimit.get_rate_limiter().reset()
+
+    output_path = os.path.join(_WORK_DIR, "e2e.jsonl")
+    try:
+        return bulk.run_batch("offline-key", items, output_path, max_workers=workers, on_record=on_record)
+    finally:
+        os.remove(output_path)
+
+def bench_end_to_end(corpus, products, workers):
+    urls = corpus.urls()
+    items = [
+        {
+            "product_name": f"ベンチマーク商品{i}",
+            "urls": [urls[(i + k) % len(urls)] for k in range(3)],
+            "notes": "",
+        }
+        for i in range(products)
+    ]
+
+    latencies = []
+
+    def on_record(record, done, total, elapsed):
+        latencies.append(record.get("elapsed_sec", 0.0))
+
+    # tracemalloc は処理を大幅に遅くするため、時間の計測とメモリの計測は別々に実行する
+    summary = _run_end_to_end(items, workers, on_record)
+    tracemalloc.start()
+    _run_end_to_end(items, workers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "products": summary["total"],
+        "failed": summary["failed"],
+        "workers": workers,
+        "elapsed_sec": summary["elapsed_sec"],
+        "products_per_minute": summary["products_per_minute"],
+        "latency_p50_sec": percentile(latencies, 50),
+        "latency_p90_sec": percentile(latencies, 90),
+        "latency_p99_sec": percentile(latencies, 99),
+    }, {
+        "tracemalloc_peak_kb": round(peak / 1024, 1),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def bench_startup(rounds):
+    code = (
+        "import time; started = time.perf_counter(); "
+        "import cache, context, jobstore, metrics, postprocess, prompts, scraper; "
+        "print(time.perf_counter() - started)"
+    )
+    times = []
+    for _ in range(rounds):
+        completed = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(completed.stdout))
+    return {
+        "rounds": rounds,
+        "import_sec_p50": round(percentile(times, 50), 4),
+        "import_sec_max": round(max(times), 4),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, baseline_path):
+    """
+    数値の指標ごとに前回結果との差分（%）を返す
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    deltas = {}
+    for suite, metrics in current["results"].items():
+        for name, value in metrics.items():
+            old = baseline.get("results", {}).get(suite, {}).get(name)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                deltas[f"{suite}.{name}"] = {"baseline": old, "current": value, "change_pct": round((value - old) / old * 100, 1)}
+    return {"baseline_commit": baseline.get("meta", {}).get("commit"), "deltas": deltas}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフライン・ベンチマーク")
+    parser.add_argument("-o", "--output", help="結果を書き出すJSONファイル")
+    parser.add_argument("--compare", help="比較対象の過去の結果JSON")
+    parser.add_argument("--products", type=int, default=30, help="エンドツーエンドで処理する商品数")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--scrape-rounds", type=int, default=5)
+    parser.add_argument("--startup-rounds", type=int, default=5, help="コールドスタート計測の回数")
+    parser.add_argument("--iterations", type=int, default=200, help="後処理ベンチマークの繰り返し回数")
+    parser.add_argument("--page-latency", type=float, default=0.05, help="競合ページ配信の遅延（秒）")
+    parser.add_argument("--model-latency", type=float, default=0.3, help="スタブAPIの平均遅延（秒）")
+    parser.add_argument("--model-jitter", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="スタブAPIが429を返す割合")
+    parser.add_argument("--retry-after", type=float, help="スタブAPIの429に付ける再試行までの秒数")
+    parser.add_argument("--rpm", type=int, default=10000, help="各モデルのレート制限（1分あたりリクエスト数）")
+    parser.add_argument("--tpm", type=int, default=100000000, help="各モデルのレート制限（1分あたりトークン数）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for model in prompts.CANDIDATE_MODELS:
+        ratelimit.RATE_LIMITS[model] = {"rpm": args.rpm, "tpm": args.tpm}
+
+    with CorpusServer(latency=args.page_latency) as corpus, \
+            FakeGeminiServer(latency=args.model_latency, jitter=args.model_jitter,
+                             failure_rate=args.failure_rate, retry_after=args.retry_after,
+                             seed=args.seed) as gemini:
+        prompts.API_BASE_URL = gemini.base_url
+
+        results = {
+            "scrape": bench_scrape(corpus, args.scrape_rounds),
+            "postprocess": bench_postprocess(gemini.responses, args.iterations),
+            "startup": bench_startup(args.startup_rounds),
+        }
+        results["end_to_end"], results["memory"] = bench_end_to_end(corpus, args.products, args.workers)
+        stub_calls = dict(gemini.calls)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+            "fixture_pages": len(corpus.pages),
+            "stub_calls": stub_calls,
+        },
+        "results": results,
+    }
+    if args.compare:
+        report["comparison"] = compare(report, args.compare)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+オフラインベンチマーク用のローカルサーバー
+
+- CorpusServer: 保存済みの競合ページ（fixtures/pages）を配信する（ETag / 304 対応）
+- FakeGeminiServer: Gemini API の generateContent / streamGenerateContent を模したスタブ。
+  記録済みの応答（fixtures/responses）を、指定した遅延・失敗率で返す
+  （構造化出力を要求された場合は、記録済みの応答を RESPONSE_SCHEMA のJSONに変換して返す）
+"""
+import glob
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+class _ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _BaseServer:
+    handler_class = None
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.httpd = _ThreadingServer((host, port), self.handler_class)
+        self.httpd.owner = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _CorpusHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        owner = self.server.owner
+        name = self.path.lstrip("/").split("?")[0]
+        if name == "sitemap.xml":
+            self._send(200, owner.sitemap(), content_type="application/xml")
+            return
+        body = owner.pages.get(name)
+        if owner.latency:
+            time.sleep(owner.latency)
+        if body is None:
+            self._send(404, b"not found")
+            return
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", etag=etag)
+            return
+        self._send(200, body, etag=etag)
+
+    def _send(self, status, body, etag=None, content_type="text/html; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class CorpusServer(_BaseServer):
+    """
+    pages_dir 内の *.html を /<ファイル名> で、その一覧を /sitemap.xml で配信する
+    """
+    handler_class = _CorpusHandler
+
+    def __init__(self, pages_dir=None, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        pages_dir = pages_dir or os.path.join(FIXTURES_DIR, "pages")
+        self.pages = {}
+        for path in sorted(glob.glob(os.path.join(pages_dir, "*.html"))):
+            with open(path, "rb") as f:
+                self.pages[os.path.basename(path)] = f.read()
+        self.latency = latency
+
+    def urls(self):
+        return [f"{self.base_url}/{name}" for name in self.pages]
+
+    def sitemap(self):
+        """
+        全ページを載せたサイトマップ（/sitemap.xml で配信する）
+        """
+        entries = "".join(f"<url><loc>{url}</loc></url>" for url in self.urls())
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</urlset>'
+        ).encode("utf-8")
+
+class _GeminiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    _path_pattern = re.compile(r"/v1beta/models/([^:/]+):(generateContent|streamGenerateContent)")
+
+    def do_POST(self):
+        owner = self.server.owner
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        match = self._path_pattern.match(self.path)
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+            return
+        model, method = match.groups()
+
+        status = owner.pick_failure(model)
+        time.sleep(owner.pick_latency())
+        if status:
+            owner.count(model, status)
+            error = {"code": status, "message": f"stub error {status}", "status": "STUB_ERROR"}
+            headers = {}
+            if status == 429 and owner.retry_after is not None:
+                error["details"] = [{
+                    "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                    "retryDelay": f"{owner.retry_after}s",
+                }]
+                headers["Retry-After"] = str(owner.retry_after)
+            self._send_json(status, {"error": error}, headers)
+            return
+
+        text = owner.pick_response()
+        if request.get("generationConfig", {}).get("responseMimeType") == "application/json":
+            text = owner.structured_response(text)
+        prompt_chars = len(json.dumps(request, ensure_ascii=False))
+        usage = {
+            "promptTokenCount": prompt_chars // 2,
+            "candidatesTokenCount": len(text) // 2,
+            "totalTokenCount": (prompt_chars + len(text)) // 2,
+        }
+        owner.count(model, 200)
+        if method == "generateContent":
+            self._send_json(200, self._payload(text, usage))
+            return
+
+        # SSE でいくつかのチャンクに分けて返す
+        size = max(1, len(text) // owner.stream_chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index, piece in enumerate(pieces):
+            payload = self._payload(piece, usage if index == len(pieces) - 1 else None)
+            data = f"data: {json.dumps(payload, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _payload(text, usage):
+        payload = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}]}
+        if usage:
+            payload["usageMetadata"] = usage
+        return payload
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeGeminiServer(_BaseServer):
+    """
+    記録済みの応答を返す Gemini API のスタブ
+
+    latency: 応答までの平均秒数（±jitter の一様乱数で揺らす）
+    failure_rate: 失敗させる割合（failure_status のステータスで返す）
+    model_failures: モデル名ごとに固定で返すステータス（例: {"gemini-3-pro-preview": 404}）
+    retry_after: 429 の応答に付ける再試行までの秒数（Retry-After ヘッダーと RetryInfo）
+    """
+    handler_class = _GeminiHandler
+
+    def __init__(self, responses_dir=None, latency=0.5, jitter=0.2, failure_rate=0.0,
+                 failure_status=429, model_failures=None, stream_chunks=8, seed=0, retry_after=None, **kwargs):
+        super().__init__(**kwargs)
+        responses_dir = responses_dir or os.path.join(FIXTURES_DIR, "responses")
+        self.responses = []
+        for path in sorted(glob.glob(os.path.join(responses_dir, "*.txt"))):
+            with open(path, encoding="utf-8") as f:
+                self.responses.append(f.read())
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.model_failures = model_failures or {}
+        self.stream_chunks = stream_chunks
+        self.retry_after = retry_after
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def pick_latency(self):
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def pick_failure(self, model):
+        if model in self.model_failures:
+            return self.model_failures[model]
+        with self._lock:
+            return self.failure_status if self._random.random() < self.failure_rate else None
+
+    def pick_response(self):
+        with self._lock:
+            return self._random.choice(self.responses)
+
+    def structured_response(self, text):
+        from postprocess import extract_fields, parse_generated_content
+
+        parsed = parse_generated_content(text)
+        fields = extract_fields(parsed)
+        return json.dumps({
+            "metadata": {key: fields[key] for key in ("title", "h1", "description", "image_abstract", "image_person")},
+            "html_content": parsed["html_content"],
+            "reviews": fields["reviews"] or [],
+            "references": fields["references"],
+        }, ensure_ascii=False)
+
+    def count(self, model, status):
+        with self._lock:
+            key = f"{model}:{status}"
+            self.calls[key] = self.calls.get(key, 0) + 1
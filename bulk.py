@@ -0,0 +1,773 @@
+"""
+複数商品の一括生成ランナー（Streamlitを使わないヘッドレス実行用）
+
+使い方:
+    python bulk.py run products.csv -o output.jsonl --workers 4
+    python bulk.py resume -o output.jsonl        # 中断した run の続きから処理する
+    python bulk.py status --dead-letters         # 進捗・スループット・残り時間の見込み
+    python bulk.py requeue                       # 上限まで失敗した商品を再び処理対象にする
+    python bulk.py refresh products.csv          # 競合ページ・入力が変わった商品だけを再生成する
+    python bulk.py section 商品名 reviews          # 1つのセクションだけを再生成して差し替える
+    python bulk.py clean output.jsonl -o cleaned.jsonl
+    python bulk.py batch products.csv -o output.jsonl  # Batch API でまとめて生成する（応答は遅いが安い）
+    python bulk.py discover https://example.com/sitemap.xml --pattern /products/  # 競合URLの検索インデックスを作る
+    python bulk.py export -o products.zip --follow  # 完了した商品を取り込み形式で書き出す（.jsonl / .zip / .sqlite）
+
+run / resume は商品ごとの状態と生成結果をジョブストア（--db、既定: data/jobs.sqlite3）に保存する。
+登録済みの商品名は追加されないため、同じ入力で run し直しても完了済みの商品は再生成しない。
+refresh は完了済みの商品の競合ページを再検証し、フィンガープリント（各URLの本文ハッシュ・特記事項・
+SYSTEM_INSTRUCTION・モデル）が生成時から変わった商品だけを再生成する。
+
+入力ファイル (CSV / JSONL) の列:
+    product_name : 商品名（必須）
+    urls         : 競合URL（改行・空白・"|" 区切りで複数可。JSONLではリストも可。
+                   空の場合は discover で作ったインデックスから探す）
+    notes        : 特記事項（任意）
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import batch_predict
+import context
+import discovery
+import exporter
+import jobstore
+import metrics
+import prompts
+import scraper
+from postprocess import SECTION_KEYS, clean_html_tags, extract_fields, parse_generated_content
+
+def _split_urls(value):
+    """
+    URL列の値（文字列またはリスト）をURLのリストに変換する
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(u).strip() for u in value if str(u).strip()]
+    return [u for u in re.split(r'[\s|]+', value) if u]
+
+def load_products(path):
+    """
+    CSVまたはJSONLファイルから商品リストを読み込む
+    """
+    products = []
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    for row in rows:
+        name = (row.get("product_name") or "").strip()
+        if not name:
+            continue
+        products.append({
+            "product_name": name,
+            "urls": _split_urls(row.get("urls")),
+            "notes": (row.get("notes") or "").strip(),
+        })
+    return products
+
+def fill_discovered_urls(products, path=None, limit=5):
+    """
+    urls が空の商品に、discover で作ったインデックスから競合URLを補い、補った商品数を返す
+    """
+    filled = 0
+    for product in products:
+        if not product["urls"]:
+            product["urls"] = discovery.find_competitor_urls(product["product_name"], limit=limit, path=path)
+            filled += bool(product["urls"])
+    return filled
+
+# 1商品あたりのスクレイピング打ち切り時間（秒）
+SCRAPE_DEADLINE = 30
+
+def source_hashes(scrape_results, previous=None):
+    """
+    URLごとの本文ハッシュを返す。取得に失敗したURLは前回のハッシュ（無ければNone）を使い、
+    一時的な取得失敗で商品が変わったと判定されないようにする
+    """
+    previous = previous or {}
+    return {
+        r["url"]: previous.get(r["url"]) if "error" in r else r["content_hash"]
+        for r in scrape_results
+    }
+
+def product_fingerprint(product, hashes, model_name=None):
+    """
+    生成結果に影響する入力（各URLの本文ハッシュ・特記事項・SYSTEM_INSTRUCTION・モデル）のハッシュ
+    """
+    payload = {
+        "sources": sorted([url, hashes.get(url)] for url in product["urls"]),
+        "notes": product.get("notes", ""),
+        "system_instruction": hashlib.sha256(prompts.SYSTEM_INSTRUCTION.encode("utf-8")).hexdigest(),
+        "model": model_name or prompts.CANDIDATE_MODELS[0],
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def prepare_product(product, model_name=None, token_budget=context.DEFAULT_TOKEN_BUDGET):
+    """
+    1商品分のスクレイピングと参考情報の作成を行い、(出力レコードの下書き, 参考情報) を返す
+    """
+    record = {
+        "product_name": product["product_name"],
+        "urls": product["urls"],
+    }
+    scrape_results = scraper.scrape_multiple_urls(product["urls"], deadline=SCRAPE_DEADLINE)
+    record["scrape_errors"] = [
+        {"url": r["url"], "error": r["error"]} for r in scrape_results if "error" in r
+    ]
+    record["source_hashes"] = source_hashes(scrape_results)
+    record["fingerprint"] = product_fingerprint(product, record["source_hashes"], model_name)
+
+    with metrics.span("context"):
+        context_text, record["context_stats"] = context.build_context(
+            scrape_results, product["product_name"], product.get("notes", ""), token_budget=token_budget
+        )
+    return record, context_text
+
+def finish_record(record, raw_response):
+    """
+    生成結果をパース・HTML整形して出力レコードに追加する（パースできなければ "error" を入れる）
+    """
+    with metrics.span("parse"):
+        parsed = parse_generated_content(raw_response)
+    if "error" in parsed:
+        record["error"] = parsed["error"]
+    else:
+        with metrics.span("clean"):
+            parsed["html_content"] = clean_html_tags(parsed.get("html_content", ""))
+        parsed["fields"] = extract_fields(parsed)
+        record.update(parsed)
+    record["raw_response"] = raw_response
+    return record
+
+def process_product(api_key, product, model_name=None, token_budget=context.DEFAULT_TOKEN_BUDGET, on_stage=None,
+                    fanout=False, structured=False, refresh=False):
+    """
+    1商品分のスクレイピング → 生成 → パース → HTML整形 を実行して出力レコードを返す
+
+    on_stage を渡すと、生成を始めるときに on_stage("generating") を呼ぶ。
+    fanout=True の場合はセクションごとに並列で生成する（prompts.generate_content_fanout）。
+    structured=True の場合はJSONスキーマに沿った構造化出力で生成する。
+    refresh=True の場合は応答キャッシュを使わずに生成し直す（失敗したジョブの再試行など）。
+    レコードの "fields" にはタイトル・H1・レビューなどの型付きの値が入る
+    """
+    started = time.time()
+
+    with metrics.start_run("bulk", product=product["product_name"]) as run:
+        record, context_text = prepare_product(product, model_name, token_budget)
+        if on_stage:
+            on_stage("generating")
+        if fanout:
+            result = prompts.generate_content_fanout(
+                api_key, context_text, product["product_name"], model_name, refresh=refresh
+            )
+            record["models"] = result["models"]
+        else:
+            result = prompts.generate_content_detailed(
+                api_key, context_text, product["product_name"], model_name, refresh=refresh, structured=structured
+            )
+        record["model"] = result["model"]
+        record["usage"] = result["usage"]
+        finish_record(record, result["text"])
+
+    record["timings"] = run.summary()
+    record["elapsed_sec"] = round(time.time() - started, 3)
+    return record
+
+def run_batch(api_key, products, output_path, model_name=None, max_workers=4, on_record=None,
+              token_budget=context.DEFAULT_TOKEN_BUDGET, store=None, fanout=False, structured=False):
+    """
+    商品リストを並列ワーカーで処理し、1商品1行のJSONLとして書き出す
+
+    store（jobstore.JobStore）を渡すと商品をジョブとして登録し、run_jobs で処理する。
+    戻り値は処理件数・失敗件数・スループット（件/分）をまとめた辞書
+    """
+    if store is not None:
+        store.enqueue(products)
+        return run_jobs(
+            api_key, store, output_path, model_name=model_name, max_workers=max_workers,
+            on_record=on_record, token_budget=token_budget, fanout=fanout, structured=structured,
+        )
+
+    started = time.time()
+    done = 0
+    failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                process_product, api_key, product, model_name, token_budget, fanout=fanout, structured=structured,
+            ): product
+            for product in products
+        }
+        for future in as_completed(futures):
+            product = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"product_name": product["product_name"], "urls": product["urls"], "error": str(e)}
+
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+            done += 1
+            if "error" in record:
+                failed += 1
+            if on_record:
+                on_record(record, done, len(products), time.time() - started)
+
+    elapsed = time.time() - started
+    return {
+        "total": done,
+        "failed": failed,
+        "elapsed_sec": round(elapsed, 3),
+        "products_per_minute": round(done / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "model_stats": prompts.get_model_stats(),
+    }
+
+def _store_record(store, job_id, record):
+    """
+    生成結果をジョブストアに保存し、結果が確定したか（完了・上限に達した失敗）を返す（False なら再試行待ち）
+    """
+    if "error" not in record:
+        store.complete(job_id, record)
+        return True
+    return not store.fail(job_id, record["error"], record)
+
+def run_jobs(api_key, store, output_path=None, model_name=None, max_workers=4, on_record=None,
+             token_budget=context.DEFAULT_TOKEN_BUDGET, fanout=False, structured=False):
+    """
+    ジョブストアの未完了ジョブを並列ワーカーで処理する（中断した後に呼ぶと続きから再開する）
+
+    失敗したジョブは試行回数の上限まで再試行し、完了したジョブと上限に達したジョブを
+    output_path に1商品1行のJSONLとして追記する
+    """
+    started = time.time()
+    store.recover()
+    total = store.progress()["remaining"]
+    counts = {"done": 0, "failed": 0, "retried": 0}
+    lock = threading.Lock()
+    out = open(output_path, "a", encoding="utf-8") if output_path else None
+
+    def worker():
+        while True:
+            job = store.claim()
+            if job is None:
+                return
+            product = job["product"]
+            try:
+                record = process_product(
+                    api_key, product, model_name, token_budget,
+                    on_stage=lambda state: store.set_state(job["id"], state),
+                    fanout=fanout, structured=structured,
+                    # 再試行では前回の（失敗した）応答をキャッシュから受け取らないようにする
+                    refresh=job["attempts"] > 1,
+                )
+            except Exception as e:
+                record = {"product_name": product["product_name"], "urls": product["urls"], "error": str(e)}
+            record["attempts"] = job["attempts"]
+
+            if not _store_record(store, job["id"], record):
+                with lock:
+                    counts["retried"] += 1
+                continue
+
+            with lock:
+                counts["done"] += 1
+                if "error" in record:
+                    counts["failed"] += 1
+                if out:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                if on_record:
+                    on_record(record, counts["done"], total, time.time() - started)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for future in [executor.submit(worker) for _ in range(max_workers)]:
+                future.result()
+    finally:
+        if out:
+            out.close()
+
+    elapsed = time.time() - started
+    return {
+        "total": counts["done"],
+        "failed": counts["failed"],
+        "retried": counts["retried"],
+        "elapsed_sec": round(elapsed, 3),
+        "products_per_minute": round(counts["done"] / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "progress": store.progress(),
+        "model_stats": prompts.get_model_stats(),
+    }
+
+def run_batch_prediction(api_key, store, output_path=None, model_name=None, max_workers=4, on_record=None,
+                         token_budget=context.DEFAULT_TOKEN_BUDGET, structured=False, transport="gemini",
+                         batch_path=None, poll_interval=batch_predict.POLL_INTERVAL, on_poll=None):
+    """
+    ジョブストアの未完了ジョブをバッチ予測でまとめて生成する
+
+    スクレイピングと参考情報の作成は並列ワーカーで行い、全商品のプロンプトを1つのバッチファイルにまとめて
+    投入する。完了を待って結果を商品ごとにジョブストアと output_path に書き出す（run_jobs と同じ形式）
+    """
+    store.recover()
+    model = model_name or prompts.CANDIDATE_MODELS[0]
+    structured = structured and prompts.supports_structured_output(model)
+    batch_path = batch_path or os.path.join(batch_predict.BATCH_DIR, f"batch-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    transport = batch_predict.TRANSPORTS[transport](api_key) if isinstance(transport, str) else transport
+    jobs = {}
+    counts = {"done": 0, "failed": 0, "retried": 0, "total": store.progress()["remaining"], "started": time.time()}
+    out = open(output_path, "a", encoding="utf-8") if output_path else None
+
+    def prepare(job):
+        product = job["product"]
+        with metrics.start_run("batch", product=product["product_name"]) as run:
+            try:
+                record, context_text = prepare_product(product, model_name, token_budget)
+            except Exception as e:
+                return job, {"product_name": product["product_name"], "urls": product["urls"], "error": str(e)}, None
+        record["timings"] = run.summary()
+        store.set_state(job["id"], "generating")
+        return job, record, batch_predict.build_request(job["id"], context_text, product["product_name"], structured)
+
+    def requests():
+        claimed = iter(store.claim, None)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for job, record, request in executor.map(prepare, claimed):
+                record["attempts"] = job["attempts"]
+                if request is None:
+                    _write_result(store, job["id"], record, counts, out, on_record)
+                    continue
+                jobs[str(job["id"])] = {"job_id": job["id"], "record": record}
+                yield request
+
+    try:
+        if not batch_predict.write_batch_file(requests(), batch_path):
+            os.remove(batch_path)
+            return _batch_summary(store, counts, None)
+        manifest = batch_predict.submit(transport, batch_path, model, {"structured": structured, "jobs": jobs})
+        return _collect_batch(store, transport, manifest, counts, out, on_record, poll_interval, on_poll)
+    finally:
+        if out:
+            out.close()
+
+def attach_batch(api_key, store, manifest_path, output_path=None, on_record=None,
+                 poll_interval=batch_predict.POLL_INTERVAL, on_poll=None):
+    """
+    投入済みのバッチ（マニフェスト）の完了を待って結果を書き出す（完了待ちの途中で終了した場合の続き）
+    """
+    manifest = batch_predict.load_manifest(manifest_path)
+    transport = batch_predict.TRANSPORTS[manifest["transport"]](api_key)
+    counts = {"done": 0, "failed": 0, "retried": 0, "total": len(manifest["jobs"]), "started": time.time()}
+    out = open(output_path, "a", encoding="utf-8") if output_path else None
+    try:
+        return _collect_batch(store, transport, manifest, counts, out, on_record, poll_interval, on_poll)
+    finally:
+        if out:
+            out.close()
+
+def _collect_batch(store, transport, manifest, counts, out, on_record, poll_interval, on_poll):
+    jobs = manifest["jobs"]
+    job_ids = [job["job_id"] for job in jobs.values()]
+
+    def heartbeat(state, elapsed):
+        # 完了待ちの間も recover で pending に戻されないよう、処理中のジョブの更新時刻を進める
+        store.touch(job_ids)
+        if on_poll:
+            on_poll(state, elapsed)
+
+    try:
+        batch_predict.wait(transport, manifest["job_name"], interval=poll_interval, on_poll=heartbeat)
+    except (RuntimeError, TimeoutError) as e:
+        # バッチ全体が失敗・期限切れになった場合は、各ジョブを失敗として記録して通常の再試行に回す
+        for job in jobs.values():
+            job["record"]["error"] = f"バッチが完了しませんでした: {e}"
+            _write_result(store, job["job_id"], job["record"], counts, out, on_record)
+        return _batch_summary(store, counts, manifest, error=str(e))
+    for key, result in batch_predict.iter_results(transport, manifest):
+        job = jobs.pop(key, None)
+        if job is None:
+            continue
+        record = job["record"]
+        if "error" in result:
+            record["error"] = result["error"]
+        else:
+            record["model"] = manifest["model"]
+            record["usage"] = result["usage"]
+            record["batch"] = manifest["job_name"]
+            finish_record(record, result["text"])
+        _write_result(store, job["job_id"], record, counts, out, on_record)
+    for job in jobs.values():
+        job["record"]["error"] = "バッチの結果に含まれていませんでした"
+        _write_result(store, job["job_id"], job["record"], counts, out, on_record)
+    return _batch_summary(store, counts, manifest)
+
+def _write_result(store, job_id, record, counts, out, on_record):
+    if not _store_record(store, job_id, record):
+        counts["retried"] += 1
+        return
+    counts["done"] += 1
+    if "error" in record:
+        counts["failed"] += 1
+    if out:
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+    if on_record:
+        on_record(record, counts["done"], counts["total"], time.time() - counts["started"])
+
+def _batch_summary(store, counts, manifest, error=None):
+    summary = {
+        "total": counts["done"],
+        "failed": counts["failed"],
+        "retried": counts["retried"],
+        "batch": manifest and manifest["job_name"],
+        "manifest": manifest and batch_predict.manifest_path(manifest["batch_path"]),
+        "progress": store.progress(),
+    }
+    if error:
+        summary["error"] = error
+    return summary
+
+def find_changed(store, model_name=None, max_workers=4, products=None):
+    """
+    完了済みの商品の競合ページを再検証し、フィンガープリントが生成時から変わった商品のジョブを返す
+
+    products を渡すと、登録済みの入力の代わりにその入力（URL・特記事項）で判定する（ストアは変更しない）
+    """
+    inputs = {product["product_name"]: product for product in products or []}
+    jobs = [dict(job, product=inputs.get(job["product_name"], job["product"])) for job in store.jobs("done")]
+
+    def changed(job):
+        results = scraper.scrape_multiple_urls(job["product"]["urls"], deadline=SCRAPE_DEADLINE, revalidate=True)
+        hashes = source_hashes(results, (job["record"] or {}).get("source_hashes"))
+        return product_fingerprint(job["product"], hashes, model_name) != job["fingerprint"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        flags = list(executor.map(changed, jobs))
+    return jobs, [job for job, flag in zip(jobs, flags) if flag]
+
+def refresh_products(api_key, store, output_path=None, products=None, model_name=None, max_workers=4,
+                     on_record=None, token_budget=context.DEFAULT_TOKEN_BUDGET, dry_run=False, fanout=False,
+                     structured=False):
+    """
+    競合ページ・入力が変わった商品だけを再生成する
+
+    products を渡すと、登録済みの商品の入力（URL・特記事項）を更新し、未登録の商品を追加する。
+    dry_run=True の場合は変わった商品・追加される商品の一覧を返すだけで、ストアは変更しない
+    """
+    checked, changed = find_changed(store, model_name, max_workers, products)
+    summary = {
+        "checked": len(checked),
+        "changed": [job["product_name"] for job in changed],
+        "added": [p["product_name"] for p in products or [] if store.find(p["product_name"]) is None],
+    }
+    if dry_run:
+        return summary
+
+    if products:
+        store.update_inputs(products)
+    store.requeue([job["id"] for job in changed])
+    summary.update(run_jobs(
+        api_key, store, output_path, model_name=model_name, max_workers=max_workers,
+        on_record=on_record, token_budget=token_budget, fanout=fanout, structured=structured,
+    ))
+    return summary
+
+def regenerate_section(api_key, store, product_name, section, model_name=None,
+                       token_budget=context.DEFAULT_TOKEN_BUDGET):
+    """
+    生成済みの商品の1つのセクションだけを再生成し、ジョブストアの結果に差し替える
+
+    他のセクションはそのまま残すため、ページ全体を生成し直すよりトークン数・時間が少なく済む
+    """
+    job = store.find(product_name)
+    if job is None or job["state"] != "done":
+        raise KeyError(f"no finished job for {product_name}")
+    product = job["product"]
+
+    with metrics.start_run("section", product=product_name, section=section) as run:
+        scrape_results = scraper.scrape_multiple_urls(product["urls"], deadline=SCRAPE_DEADLINE)
+        with metrics.span("context"):
+            context_text, _ = context.build_context(
+                scrape_results, product_name, product.get("notes", ""), token_budget=token_budget
+            )
+        result = prompts.generate_section(
+            api_key, context_text, product_name, section, model_name,
+            current_sections=job["sections"] or parse_generated_content(job["raw_response"] or ""),
+            refresh=True,
+        )
+
+    summary = {
+        "product_name": product_name,
+        "section": section,
+        "model": result["model"],
+        "usage": result["usage"],
+        "timings": run.summary(),
+    }
+    if result["text"].startswith("Error:"):
+        summary["error"] = result["text"]
+        return summary
+
+    value = result["text"]
+    if section == "html_content":
+        value = clean_html_tags(value)
+    store.update_section(product_name, section, value)
+    return summary
+
+def clean_records(input_path, output_path):
+    """
+    出力済みJSONLの html_content を clean_html_tags で整形し直して別ファイルに書き出す
+    （1行ずつ処理するため、件数が多くてもメモリ使用量は一定）
+    """
+    count = 0
+    with open(input_path, encoding="utf-8") as src, open(output_path, "w", encoding="utf-8") as out:
+        for line in src:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("html_content"):
+                record["html_content"] = clean_html_tags(record["html_content"])
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+def export_jobs(store, output_path, fmt=None, finished_after=0.0, follow=False, interval=10.0):
+    """
+    完了した商品を取り込み形式で output_path に追記し、件数と最後に書き出した完了時刻を返す
+
+    follow=True のときは、未完了の商品が無くなるまで interval 秒ごとに新しく完了した商品を書き出す
+    （一括生成と並行して実行できる）。返した until を次回の finished_after に渡すと続きから書き出せる
+    """
+    count, until = 0, finished_after
+    with exporter.open_exporter(output_path, fmt) as out:
+        while True:
+            # 未完了の商品が無いことを先に確認してから取り出す（確認と取り出しの間に完了した商品も最後に書き出す）
+            if follow:
+                status = store.progress()
+                last = not any(status[state] for state in ("pending", "scraping", "generating"))
+            for job in store.jobs("done", finished_after=until):
+                out.write(exporter.export_row(job))
+                count += 1
+                until = job["finished_at"]
+            if not follow or last:
+                break
+            time.sleep(interval)
+    return {"exported": count, "until": until}
+
+def _print_progress(record, done, total, elapsed):
+    rate = done / elapsed * 60 if elapsed > 0 else 0.0
+    mark = "NG" if "error" in record else "OK"
+    print(f"[{done}/{total}] {mark} {record['product_name']} ({rate:.1f} 件/分)", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="商品詳細ページの一括生成")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # 複数のサブコマンドで共通のオプション（parents で各サブコマンドに取り込む）
+    db_options = argparse.ArgumentParser(add_help=False)
+    db_options.add_argument("--db", default=jobstore.JOB_DB, help="ジョブストアのSQLiteファイル")
+
+    generate_options = argparse.ArgumentParser(add_help=False, parents=[db_options])
+    generate_options.add_argument("-m", "--model", default=None, help="優先して使用するモデル名")
+    generate_options.add_argument("--token-budget", type=int, default=context.DEFAULT_TOKEN_BUDGET, help="参考情報の上限トークン数")
+    generate_options.add_argument("--api-key", default=os.getenv("GEMINI_API_KEY"), help="Gemini APIキー（既定: 環境変数 GEMINI_API_KEY）")
+
+    bulk_options = argparse.ArgumentParser(add_help=False, parents=[generate_options])
+    bulk_options.add_argument("-o", "--output", default="output.jsonl", help="出力先JSONL（追記）")
+    bulk_options.add_argument("-w", "--workers", type=int, default=4, help="並列ワーカー数")
+    bulk_options.add_argument("--structured", action="store_true", help="JSONスキーマに沿った構造化出力で生成する")
+
+    discovery_options = argparse.ArgumentParser(add_help=False)
+    discovery_options.add_argument("--discovery-db", default=discovery.DISCOVERY_DB, help="urls が空の商品の競合URLを探す検索インデックス")
+
+    run_parser = subparsers.add_parser("run", parents=[bulk_options, discovery_options], help="入力ファイルの全商品を生成する")
+    run_parser.add_argument("input", help="商品リスト (CSV / JSONL)")
+    run_parser.add_argument("--fanout", action="store_true", help="セクションごとに並列で生成する（本文以外は速いモデルを使う）")
+    run_parser.add_argument("--no-db", action="store_true", help="ジョブストアを使わずに入力の全商品を生成する")
+    run_parser.add_argument("--max-attempts", type=int, default=jobstore.MAX_ATTEMPTS, help="1商品あたりの最大試行回数")
+
+    resume_parser = subparsers.add_parser("resume", parents=[bulk_options], help="ジョブストアの未完了の商品を続きから生成する")
+    resume_parser.add_argument("--fanout", action="store_true", help="セクションごとに並列で生成する（本文以外は速いモデルを使う）")
+    resume_parser.add_argument("--max-attempts", type=int, default=jobstore.MAX_ATTEMPTS, help="1商品あたりの最大試行回数")
+    resume_parser.add_argument(
+        "--stale-after", type=float, default=jobstore.STALE_AFTER,
+        help="処理中のまま更新が止まったジョブを再処理するまでの秒数（異常終了直後に再開する場合は 0）",
+    )
+
+    status_parser = subparsers.add_parser("status", parents=[db_options], help="ジョブストアの進捗を表示する")
+    status_parser.add_argument("--dead-letters", action="store_true", help="上限まで失敗した商品の一覧も表示する")
+
+    subparsers.add_parser("requeue", parents=[db_options], help="上限まで失敗した商品を再び処理対象にする")
+
+    refresh_parser = subparsers.add_parser(
+        "refresh", parents=[bulk_options, discovery_options], help="競合ページ・入力が変わった商品だけを再生成する",
+    )
+    refresh_parser.add_argument("input", nargs="?", help="更新後の商品リスト (CSV / JSONL、省略時は登録済みの入力のまま)")
+    refresh_parser.add_argument("--fanout", action="store_true", help="セクションごとに並列で生成する（本文以外は速いモデルを使う）")
+    refresh_parser.add_argument("--dry-run", action="store_true", help="変わった商品を表示するだけで再生成しない")
+
+    clean_parser = subparsers.add_parser("clean", help="出力済みJSONLのHTMLから見出し・表・リストの属性を削除する")
+    clean_parser.add_argument("input", help="bulk run の出力JSONL")
+    clean_parser.add_argument("-o", "--output", required=True, help="整形後の出力先JSONL")
+
+    discover_parser = subparsers.add_parser("discover", help="競合サイトのサイトマップから商品ページの検索インデックスを作る")
+    discover_parser.add_argument("sitemaps", nargs="*", help="サイトマップのURL（インデックス・gzip も可）")
+    discover_parser.add_argument("--pattern", default=None, help="対象にする商品ページのURLの正規表現")
+    discover_parser.add_argument("-w", "--workers", type=int, default=scraper.MAX_WORKERS, help="並列取得数")
+    discover_parser.add_argument("--refresh", action="store_true", help="lastmod が変わっていないページも取得し直す")
+    discover_parser.add_argument("--lookup", default=None, help="取得せずに、この商品名の競合URLを検索して表示する")
+    discover_parser.add_argument("--discovery-db", default=discovery.DISCOVERY_DB, help="検索インデックスのSQLiteファイル")
+
+    batch_parser = subparsers.add_parser(
+        "batch", parents=[bulk_options, discovery_options],
+        help="未完了の商品をバッチ予測（Batch API）でまとめて生成する（夜間の一括更新向け）",
+        description="-w はスクレイピングの並列数。バッチでは -m のモデルだけを使い、モデルを切り替えない",
+    )
+    batch_parser.add_argument("input", nargs="?", help="追加する商品リスト (CSV / JSONL、省略時は登録済みの未完了の商品)")
+    batch_parser.add_argument("--max-attempts", type=int, default=jobstore.MAX_ATTEMPTS, help="1商品あたりの最大試行回数")
+    batch_parser.add_argument("--transport", choices=sorted(batch_predict.TRANSPORTS), default="gemini",
+                              help="バッチの送信先（local は1件ずつ generate_content に送る確認用の代替）")
+    batch_parser.add_argument("--poll-interval", type=float, default=batch_predict.POLL_INTERVAL, help="完了確認の最初の間隔（秒）")
+    batch_parser.add_argument("--attach", default=None, help="投入済みのバッチのマニフェスト（完了待ちの途中で終了した場合に続きから受け取る）")
+
+    export_parser = subparsers.add_parser(
+        "export", parents=[db_options], help="生成結果をストアの取り込み形式で書き出す（JSONL / zip / SQLite）",
+    )
+    export_parser.add_argument("-o", "--output", required=True, help="出力先（.zip / .sqlite / それ以外は JSONL、いずれも追記）")
+    export_parser.add_argument("--format", choices=sorted(exporter.EXPORTERS), default=None, help="出力形式（既定: 拡張子から判定）")
+    export_parser.add_argument("--from-jsonl", default=None, help="ジョブストアではなく bulk run の出力JSONLから書き出す")
+    export_parser.add_argument("--since", type=float, default=0.0, help="この時刻（UNIX秒、前回の until）より後に完了した商品だけを書き出す")
+    export_parser.add_argument("--follow", action="store_true", help="一括生成が終わるまで、新しく完了した商品を書き出し続ける")
+    export_parser.add_argument("--interval", type=float, default=10.0, help="--follow の確認間隔（秒）")
+
+    section_parser = subparsers.add_parser("section", parents=[generate_options], help="生成済みの商品の1つのセクションだけを再生成する")
+    section_parser.add_argument("product_name", help="商品名")
+    section_parser.add_argument("section", choices=SECTION_KEYS, help="再生成するセクション")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "clean":
+        print(json.dumps({"cleaned": clean_records(args.input, args.output)}))
+        return
+
+    if args.command == "discover":
+        index = discovery.DiscoveryIndex(args.discovery_db)
+        if args.lookup:
+            print(json.dumps(index.lookup(args.lookup), ensure_ascii=False))
+            return
+        if not args.sitemaps:
+            parser.error("サイトマップのURLを指定してください")
+        summary = discovery.crawl(
+            args.sitemaps, index, pattern=args.pattern, refresh=args.refresh, max_workers=args.workers,
+            on_chunk=lambda s: print(f"{s['indexed']} 件を登録", file=sys.stderr),
+        )
+        print(json.dumps({**summary, **index.stats()}, ensure_ascii=False))
+        return
+
+    if args.command == "export":
+        if args.from_jsonl:
+            with exporter.open_exporter(args.output, args.format) as out:
+                summary = {"exported": exporter.export_records(exporter.iter_jsonl(args.from_jsonl), out)}
+        else:
+            summary = export_jobs(
+                jobstore.JobStore(args.db), args.output, fmt=args.format,
+                finished_after=args.since, follow=args.follow, interval=args.interval,
+            )
+        print(json.dumps(summary, ensure_ascii=False))
+        return
+
+    if args.command == "status":
+        store = jobstore.JobStore(args.db)
+        status = store.progress()
+        if args.dead_letters:
+            status["dead_letters"] = store.dead_letters()
+        print(json.dumps(status, ensure_ascii=False))
+        return
+
+    if args.command == "requeue":
+        print(json.dumps({"requeued": jobstore.JobStore(args.db).requeue_failed()}))
+        return
+
+    products = None
+    if args.command in ("run", "refresh", "batch") and args.input:
+        products = load_products(args.input)
+        fill_discovered_urls(products, args.discovery_db)
+
+    if args.command == "refresh" and args.dry_run:
+        summary = refresh_products(
+            None, jobstore.JobStore(args.db), products=products,
+            model_name=args.model, max_workers=args.workers, dry_run=True,
+        )
+        print(json.dumps(summary, ensure_ascii=False))
+        return
+
+    if not args.api_key:
+        parser.error("APIキーが指定されていません（--api-key または GEMINI_API_KEY）")
+
+    if args.command == "run":
+        store = None if args.no_db else jobstore.JobStore(args.db, max_attempts=args.max_attempts)
+        summary = run_batch(
+            args.api_key, products, args.output,
+            model_name=args.model, max_workers=args.workers, on_record=_print_progress,
+            token_budget=args.token_budget, store=store, fanout=args.fanout, structured=args.structured,
+        )
+        print(json.dumps(summary, ensure_ascii=False))
+
+    if args.command == "refresh":
+        summary = refresh_products(
+            args.api_key, jobstore.JobStore(args.db), args.output,
+            products=products,
+            model_name=args.model, max_workers=args.workers, on_record=_print_progress,
+            token_budget=args.token_budget, fanout=args.fanout, structured=args.structured,
+        )
+        print(json.dumps(summary, ensure_ascii=False))
+
+    if args.command == "batch":
+        store = jobstore.JobStore(args.db, max_attempts=args.max_attempts)
+        on_poll = lambda state, elapsed: print(f"batch: {state} ({elapsed:.0f}秒経過)", file=sys.stderr)
+        if args.attach:
+            summary = attach_batch(
+                args.api_key, store, args.attach, args.output, on_record=_print_progress,
+                poll_interval=args.poll_interval, on_poll=on_poll,
+            )
+        else:
+            if products:
+                store.enqueue(products)
+            summary = run_batch_prediction(
+                args.api_key, store, args.output, model_name=args.model, max_workers=args.workers,
+                on_record=_print_progress, token_budget=args.token_budget, structured=args.structured,
+                transport=args.transport, poll_interval=args.poll_interval, on_poll=on_poll,
+            )
+        print(json.dumps(summary, ensure_ascii=False))
+
+    if args.command == "section":
+        summary = regenerate_section(
+            args.api_key, jobstore.JobStore(args.db), args.product_name, args.section,
+            model_name=args.model, token_budget=args.token_budget,
+        )
+        print(json.dumps(summary, ensure_ascii=False))
+
+    if args.command == "resume":
+        store = jobstore.JobStore(args.db, max_attempts=args.max_attempts, stale_after=args.stale_after)
+        summary = run_jobs(
+            args.api_key, store, args.output,
+            model_name=args.model, max_workers=args.workers, on_record=_print_progress,
+            token_budget=args.token_budget, fanout=args.fanout, structured=args.structured,
+        )
+        print(json.dumps(summary, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+ローカルのディスクキャッシュ（SQLite）
+
+複数プロセス（一括生成ワーカーとStreamlitアプリ）から同じファイルを共有できるよう、
+SQLiteのWALモードで保存する。キャッシュの保存先は環境変数 LPGEN_CACHE_DIR で変更できる。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.getenv("LPGEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+class _SQLiteStore:
+    """
+    スレッドごとに接続を持つSQLiteストアの共通処理
+    """
+    schema = ""
+    table = ""
+    key_column = ""
+    max_bytes = None
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.schema)
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _incr(self, conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def _evict(self, conn):
+        """
+        合計サイズが max_bytes を超えていれば、最終アクセスが古い順に削除する (LRU)
+        """
+        if not self.max_bytes:
+            return
+        total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        rows = conn.execute(f"SELECT {self.key_column} AS key, size FROM {self.table} ORDER BY accessed_at").fetchall()
+        for row in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute(f"DELETE FROM {self.table} WHERE {self.key_column} = ?", (row["key"],))
+            total -= row["size"]
+            evicted += 1
+        self._incr(conn, "evictions", evicted)
+
+    def clear(self):
+        """
+        全エントリとカウンターを削除する
+        """
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.execute("DELETE FROM stats")
+
+    def stats(self):
+        """
+        ヒット数・ミス数などのカウンターを辞書で返す（全プロセス合算）
+        """
+        conn = self._connect()
+        return {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM stats")}
+
+class PageCache(_SQLiteStore):
+    """
+    スクレイピング結果（タイトル・本文）をURL単位で保存するキャッシュ
+
+    - ttl 秒以内のエントリはネットワークに出ずにそのまま返す
+    - 期限切れのエントリは ETag / Last-Modified で再検証し、304なら再取得・再解析を省略する
+    - 合計サイズが max_bytes を超えたら最終アクセスが古い順に削除する (LRU)
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS pages (
+        url TEXT PRIMARY KEY,
+        title TEXT,
+        content TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        size INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_pages_accessed ON pages (accessed_at);
+    """
+    table = "pages"
+    key_column = "url"
+
+    def __init__(self, path=None, ttl=24 * 3600, max_bytes=200 * 1024 * 1024):
+        super().__init__(path or os.path.join(CACHE_DIR, "pages.sqlite3"))
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def get(self, url):
+        """
+        キャッシュエントリを返す（無ければNone）。fresh キーで有効期限内かどうかを示す
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["fresh"] = time.time() - entry["fetched_at"] < self.ttl
+        return entry
+
+    def conditional_headers(self, entry):
+        """
+        再検証リクエスト用のヘッダーを作成する
+        """
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, url):
+        """
+        有効期限内のエントリを利用したことを記録する
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self._incr(conn, "hits")
+
+    def revalidated(self, url):
+        """
+        304 Not Modified を受け取ったエントリの有効期限を延長する
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self._incr(conn, "revalidated")
+
+    def put(self, url, title, content, etag=None, last_modified=None):
+        """
+        新しく取得したページを保存し、上限を超えた分を削除する
+        """
+        now = time.time()
+        size = len((title or "").encode("utf-8")) + len((content or "").encode("utf-8"))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (url, title, content, etag, last_modified, size, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, title, content, etag, last_modified, size, now, now),
+            )
+            self._incr(conn, "misses")
+            self._evict(conn)
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """
+    プロセス内で共有するページキャッシュを返す
+    """
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache()
+        return _page_cache
+
+class ResponseCache(_SQLiteStore):
+    """
+    生成AIの応答を (システムプロンプト, ユーザープロンプト, モデル, 生成設定) のハッシュで保存するキャッシュ
+
+    合計サイズが max_bytes を超えたら最終アクセスが古い順に削除する (LRU)
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        text TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at);
+    """
+    table = "responses"
+    key_column = "key"
+
+    def __init__(self, path=None, max_bytes=100 * 1024 * 1024):
+        super().__init__(path or os.path.join(CACHE_DIR, "responses.sqlite3"))
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(system_instruction, user_prompt, model, config=None):
+        """
+        リクエスト内容からキャッシュキー（SHA-256）を作成する
+        """
+        payload = json.dumps(
+            {"system": system_instruction, "prompt": user_prompt, "model": model, "config": config or {}},
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        キャッシュ済みの応答を {"text", "model"} で返す（無ければNone）
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT text, model FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._incr(conn, "misses")
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._incr(conn, "hits")
+            return {"text": row["text"], "model": row["model"]}
+
+    def put(self, key, text, model=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, text, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, text, len(text.encode("utf-8")), now, now),
+            )
+            self._evict(conn)
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """
+    プロセス内で共有する応答キャッシュを返す
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
@@ -0,0 +1,159 @@
+import re
+import zlib
+
+# 参考情報の既定のトークン上限
+DEFAULT_TOKEN_BUDGET = 8000
+
+# パッセージ（重複判定・順位付けの単位）の目安の長さ（文字数）
+PASSAGE_CHARS = 300
+# 文字n-gramの長さと、重複とみなすJaccard係数
+SHINGLE_SIZE = 5
+DUPLICATE_THRESHOLD = 0.6
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?])\s*|(?<=\.)\s+")
+_CJK_SENTENCE_ENDS = ("。", "！", "？")
+
+def build_context_text(scrape_results, additional_info=""):
+    """
+    スクレイピング結果と特記事項からAIに渡す参考情報テキストを作成する
+    （取得に失敗したURLはスキップする）
+    """
+    context_text = ""
+    for res in scrape_results:
+        if "error" in res:
+            continue
+        context_text += f"\n--- Source: {res['url']} ---\nTitle: {res['title']}\nContent: {res['content']}\n"
+
+    if additional_info:
+        context_text += f"\n--- User Note ---\n{additional_info}\n"
+
+    return context_text
+
+def estimate_tokens(text):
+    """
+    トークン数を概算する（英数字は約4文字で1トークン、日本語などは1文字1トークン）
+    """
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def split_passages(text, size=PASSAGE_CHARS):
+    """
+    本文を文の区切りでまとめ、おおよそ size 文字ごとのパッセージに分割する
+    """
+    passages = []
+    current = ""
+    for sentence in _SENTENCE_END.split(text):
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) > size:
+            passages.append(current.strip())
+            current = ""
+        # 日本語の文はそのまま、英語の文は空白を挟んでつなぐ
+        current += " " + sentence if current and not current.endswith(_CJK_SENTENCE_ENDS) else sentence
+        # 文の区切りが無い長文は size ごとに切る
+        while len(current) > size * 2:
+            passages.append(current[:size].strip())
+            current = current[size:]
+    if current.strip():
+        passages.append(current.strip())
+    return passages
+
+def _shingles(text, k=SHINGLE_SIZE):
+    text = re.sub(r"\s+", "", text.lower())
+    if len(text) <= k:
+        return {zlib.crc32(text.encode("utf-8"))} if text else set()
+    return {zlib.crc32(text[i:i + k].encode("utf-8")) for i in range(len(text) - k + 1)}
+
+def _relevance(passage, name_bigrams, product_name):
+    """
+    商品名との関連度（商品名の出現回数 + 商品名の文字bigramの一致率）
+    """
+    if not name_bigrams:
+        return 0.0
+    lowered = passage.lower()
+    hits = sum(1 for bigram in name_bigrams if bigram in lowered)
+    return lowered.count(product_name.lower()) + hits / len(name_bigrams)
+
+def build_context(scrape_results, product_name, additional_info="", token_budget=DEFAULT_TOKEN_BUDGET):
+    """
+    重複を除き、商品名との関連度順にトークン上限まで詰めた参考情報テキストを作成する
+
+    1. 各ソースの本文をパッセージに分割する
+    2. 文字n-gram（shingle）のJaccard係数で、ソースをまたいだほぼ同じ内容のパッセージを除く
+    3. 商品名との関連度で順位付けし、token_budget に収まる分だけ採用する
+    4. 採用したパッセージをソースごとに元の順番で並べる
+
+    戻り値: (参考情報テキスト, 統計情報の辞書)
+    """
+    sources = [res for res in scrape_results if "error" not in res]
+    baseline_tokens = estimate_tokens(build_context_text(sources, additional_info))
+
+    name = (product_name or "").strip()
+    name_bigrams = {name.lower()[i:i + 2] for i in range(len(name) - 1)} or ({name.lower()} if name else set())
+
+    candidates = []
+    for source_index, res in enumerate(sources):
+        for position, passage in enumerate(split_passages(res.get("content", ""))):
+            candidates.append({
+                "source": source_index,
+                "position": position,
+                "text": passage,
+                "shingles": _shingles(passage),
+                "score": _relevance(passage, name_bigrams, name),
+            })
+
+    # ほぼ同じ内容のパッセージを除外（先に出現したものを残す）
+    kept = []
+    duplicates = 0
+    for cand in candidates:
+        is_duplicate = False
+        for other in kept:
+            inter = len(cand["shingles"] & other["shingles"])
+            if not inter:
+                continue
+            union = len(cand["shingles"]) + len(other["shingles"]) - inter
+            if inter / union >= DUPLICATE_THRESHOLD:
+                is_duplicate = True
+                break
+        if is_duplicate:
+            duplicates += 1
+        else:
+            kept.append(cand)
+
+    # ソースの見出し・特記事項の分を差し引いてから関連度順に詰める
+    note_text = f"\n--- User Note ---\n{additional_info}\n" if additional_info else ""
+    remaining = token_budget - estimate_tokens(note_text)
+    for res in sources:
+        remaining -= estimate_tokens(f"\n--- Source: {res['url']} ---\nTitle: {res['title']}\nContent: \n")
+
+    selected = []
+    dropped = 0
+    # 関連度が同じなら各ソースの先頭に近いものを優先
+    for cand in sorted(kept, key=lambda c: (-c["score"], c["position"], c["source"])):
+        cost = estimate_tokens(cand["text"]) + 1
+        if cost <= remaining:
+            selected.append(cand)
+            remaining -= cost
+        else:
+            dropped += 1
+
+    context_text = ""
+    for source_index, res in enumerate(sources):
+        passages = sorted((c for c in selected if c["source"] == source_index), key=lambda c: c["position"])
+        if not passages:
+            continue
+        content = " ".join(c["text"] for c in passages)
+        context_text += f"\n--- Source: {res['url']} ---\nTitle: {res['title']}\nContent: {content}\n"
+    context_text += note_text
+
+    context_tokens = estimate_tokens(context_text)
+    stats = {
+        "sources": len(sources),
+        "passages": len(candidates),
+        "duplicates_removed": duplicates,
+        "dropped_by_budget": dropped,
+        "baseline_tokens": baseline_tokens,
+        "context_tokens": context_tokens,
+        "tokens_saved": max(0, baseline_tokens - context_tokens),
+    }
+    return context_text, stats
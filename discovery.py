@@ -0,0 +1,327 @@
+"""
+競合サイトのサイトマップから商品ページを集めた検索インデックス（SQLite FTS5）
+
+    python bulk.py discover https://example.com/sitemap.xml --pattern /products/
+    discovery.find_competitor_urls("シルデナフィル 50mg")  # 競合サイトごとに最も近い商品ページのURL
+
+- サイトマップ（サイトマップインデックス・gzip も可）を並列に読み、商品ページを scraper で取得して
+  タイトルから商品名を取り出す。取得したページは scraper のページキャッシュにも残るので、
+  生成時のスクレイピングはキャッシュから返る
+- 商品名は NFKC・小文字化・サイト名や「通販」などの定型語を除いた形で保存し、
+  トライグラムの全文検索で部分一致を探す（日本語の商品名も分かち書き無しで検索できる）
+- 2回目以降は、サイトマップの lastmod が変わっていないページを取得し直さない
+- 保存先は環境変数 LPGEN_DISCOVERY_DB で変更できる
+"""
+import gzip
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import metrics
+import scraper
+
+DISCOVERY_DB = os.getenv(
+    "LPGEN_DISCOVERY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "discovery.sqlite3")
+)
+
+# サイトマップの上限（サイトマップの仕様上の最大は 50MB / 50,000 URL）
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+MAX_SITEMAP_DEPTH = 3
+# 一度に scrape_multiple_urls に渡すページ数（件数が多くてもメモリ使用量を一定に保つ）
+CRAWL_CHUNK = 200
+
+# タイトルからサイト名を切り離す区切り（最初の区切りより前を商品名とする）
+TITLE_SEPARATORS = r"\s[|｜\-–—:：]\s|[|｜]"
+# 商品名から除く定型語
+TITLE_NOISE = re.compile(r"【[^】]*】|\[[^\]]*\]|の?(通販|個人輸入|最安値|購入|販売)|公式|送料無料")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL UNIQUE,
+    host TEXT NOT NULL,
+    title TEXT NOT NULL,
+    name TEXT NOT NULL,
+    lastmod TEXT,
+    indexed_at REAL NOT NULL
+);
+"""
+
+# トライグラムの全文検索（SQLite 3.34 以降）。使えない環境では LIKE で検索する
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(name, content='pages', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS pages_ai AFTER INSERT ON pages BEGIN
+    INSERT INTO pages_fts (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS pages_ad AFTER DELETE ON pages BEGIN
+    INSERT INTO pages_fts (pages_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS pages_au AFTER UPDATE ON pages BEGIN
+    INSERT INTO pages_fts (pages_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO pages_fts (rowid, name) VALUES (new.id, new.name);
+END;
+"""
+
+def normalize_name(text):
+    """
+    検索用に商品名を正規化する（NFKC・小文字化・定型語と空白の除去）
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = TITLE_NOISE.sub(" ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def product_title(title):
+    """
+    ページタイトルからサイト名を除いた商品名の部分を返す
+    """
+    head = re.split(TITLE_SEPARATORS, title or "", maxsplit=1)[0]
+    return head.strip() or (title or "").strip()
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def read_sitemap(url, session=None):
+    """
+    サイトマップを読み込み、(ページの [(url, lastmod)], 子サイトマップの [url]) を返す
+    """
+    session = session or scraper.get_session()
+    response = session.get(url, timeout=30, stream=True)
+    if not response.ok:
+        response.close()
+    response.raise_for_status()
+    body = scraper.read_limited(response, MAX_SITEMAP_BYTES)
+    if body[:2] == b"\x1f\x8b":
+        body = gzip.decompress(body)
+
+    root = ElementTree.fromstring(body)
+    pages, sitemaps = [], []
+    for entry in root:
+        values = {_local_name(child.tag): (child.text or "").strip() for child in entry}
+        if not values.get("loc"):
+            continue
+        if _local_name(entry.tag) == "sitemap":
+            sitemaps.append(values["loc"])
+        else:
+            pages.append((values["loc"], values.get("lastmod") or None))
+    return pages, sitemaps
+
+def iter_sitemap_pages(sitemap_urls, max_workers=scraper.MAX_WORKERS, errors=None):
+    """
+    サイトマップ（インデックスは子サイトマップまでたどる）を並列に読み、(url, lastmod) を順に返す
+
+    読み込めなかったサイトマップは errors（リスト）に {"url", "error"} として追加する
+    """
+    seen = set()
+    level = list(dict.fromkeys(sitemap_urls))
+    session = scraper.get_session()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(MAX_SITEMAP_DEPTH + 1):
+            level = [url for url in level if url not in seen]
+            if not level:
+                break
+            seen.update(level)
+            futures = [(url, executor.submit(read_sitemap, url, session)) for url in level]
+            level = []
+            for url, future in futures:
+                try:
+                    pages, children = future.result()
+                except Exception as e:
+                    if errors is not None:
+                        errors.append({"url": url, "error": str(e)})
+                    continue
+                level.extend(children)
+                yield from pages
+
+class DiscoveryIndex:
+    """
+    商品ページのURLと正規化した商品名を保存する SQLite の検索インデックス
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DISCOVERY_DB
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        try:
+            conn.executescript(_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, pages):
+        """
+        ページ（url, title, lastmod を持つ辞書）を追加・更新する
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for page in pages:
+                title = product_title(page["title"])
+                conn.execute(
+                    "INSERT INTO pages (url, host, title, name, lastmod, indexed_at) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (url) DO UPDATE SET title = excluded.title, name = excluded.name, "
+                    "lastmod = excluded.lastmod, indexed_at = excluded.indexed_at",
+                    (page["url"], urlparse(page["url"]).netloc.lower(), title, normalize_name(title),
+                     page.get("lastmod"), now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def lastmods(self, urls):
+        """
+        登録済みのURLと、登録時のサイトマップの lastmod を返す
+        """
+        conn = self._connect()
+        found = {}
+        urls = list(urls)
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            rows = conn.execute(
+                f"SELECT url, lastmod FROM pages WHERE url IN ({', '.join('?' for _ in chunk)})", chunk
+            )
+            found.update((row["url"], row["lastmod"]) for row in rows)
+        return found
+
+    def search(self, product_name, limit=20):
+        """
+        商品名のすべての語を含むページを、商品名が短い（余計な語が少ない）順に返す
+        """
+        terms = normalize_name(product_name).split()
+        if not terms:
+            return []
+        # トライグラムは3文字以上の語だけを検索でき、短い語は LIKE で絞り込む
+        long_terms = [t for t in terms if len(t) >= 3] if self.fts else []
+        short_terms = [t for t in terms if t not in long_terms]
+        conditions, params = [], []
+        if long_terms:
+            conditions.append("id IN (SELECT rowid FROM pages_fts WHERE pages_fts MATCH ?)")
+            params.append(" AND ".join('"%s"' % t.replace('"', '""') for t in long_terms))
+        for term in short_terms:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append("%" + re.sub(r"([%_\\])", r"\\\1", term) + "%")
+        rows = self._connect().execute(
+            f"SELECT url, host, title, name FROM pages WHERE {' AND '.join(conditions)} "
+            "ORDER BY length(name), url LIMIT ?",
+            (*params, limit),
+        )
+        return [dict(row) for row in rows]
+
+    def lookup(self, product_name, limit=5):
+        """
+        競合サイト（ホスト）ごとに最も近い商品ページを1件ずつ、最大 limit 件返す
+        """
+        results, hosts = [], set()
+        for page in self.search(product_name, limit=limit * 10):
+            if page["host"] in hosts:
+                continue
+            hosts.add(page["host"])
+            results.append(page)
+            if len(results) >= limit:
+                break
+        return results
+
+    def stats(self):
+        conn = self._connect()
+        return {
+            "pages": conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0],
+            "hosts": conn.execute("SELECT COUNT(DISTINCT host) FROM pages").fetchone()[0],
+            "fts": self.fts,
+        }
+
+def crawl(sitemap_urls, index=None, pattern=None, refresh=False, max_workers=scraper.MAX_WORKERS, on_chunk=None):
+    """
+    サイトマップの商品ページを取得してインデックスに登録し、件数の集計を返す
+
+    pattern（正規表現）を指定すると、URLが一致するページだけを対象にする。
+    refresh=False の場合、登録済みで lastmod が変わっていないページは取得しない。
+    on_chunk を渡すと、CRAWL_CHUNK 件ごとに on_chunk(集計) を呼ぶ
+    """
+    index = index or get_discovery_index()
+    matcher = re.compile(pattern) if pattern else None
+    summary = {"sitemap_pages": 0, "skipped": 0, "indexed": 0, "errors": 0, "sitemap_errors": []}
+
+    def flush(chunk):
+        results = scraper.scrape_multiple_urls([url for url, _ in chunk], max_workers=max_workers)
+        lastmods = dict(chunk)
+        pages = [
+            {"url": r["url"], "title": r["title"], "lastmod": lastmods[r["url"]]}
+            for r in results if "error" not in r and r["title"] != "No Title"
+        ]
+        index.add(pages)
+        summary["indexed"] += len(pages)
+        summary["errors"] += len(results) - len(pages)
+        if on_chunk:
+            on_chunk(summary)
+
+    with metrics.span("discovery.crawl", sitemaps=len(sitemap_urls)) as span:
+        chunk = []
+        pages = iter_sitemap_pages(sitemap_urls, max_workers=max_workers, errors=summary["sitemap_errors"])
+        for url, lastmod in pages:
+            if matcher and not matcher.search(url):
+                continue
+            summary["sitemap_pages"] += 1
+            chunk.append((url, lastmod))
+            if len(chunk) >= CRAWL_CHUNK:
+                chunk = _drop_unchanged(index, chunk, refresh, summary)
+                if len(chunk) >= CRAWL_CHUNK:
+                    flush(chunk)
+                    chunk = []
+        chunk = _drop_unchanged(index, chunk, refresh, summary)
+        if chunk:
+            flush(chunk)
+        span.update(pages=summary["sitemap_pages"], indexed=summary["indexed"])
+    return summary
+
+def _drop_unchanged(index, chunk, refresh, summary):
+    """
+    登録済みで lastmod が変わっていないページを除く（lastmod の無いページは登録済みなら除く）
+    """
+    if refresh or not chunk:
+        return chunk
+    known = index.lastmods(url for url, _ in chunk)
+    kept = [(url, lastmod) for url, lastmod in chunk if url not in known or (lastmod and known[url] != lastmod)]
+    summary["skipped"] += len(chunk) - len(kept)
+    return kept
+
+_discovery_index = None
+_discovery_index_lock = threading.Lock()
+
+def get_discovery_index():
+    """
+    既定の保存先（DISCOVERY_DB）のインデックスを返す
+    """
+    global _discovery_index
+    with _discovery_index_lock:
+        if _discovery_index is None:
+            _discovery_index = DiscoveryIndex()
+        return _discovery_index
+
+def find_competitor_urls(product_name, limit=5, path=None):
+    """
+    インデックスから商品の競合URLを探す（インデックスが未作成なら空のリスト）
+    """
+    path = path or DISCOVERY_DB
+    if not os.path.exists(path):
+        return []
+    index = get_discovery_index() if path == DISCOVERY_DB else DiscoveryIndex(path)
+    return [page["url"] for page in index.lookup(product_name, limit=limit)]
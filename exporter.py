@@ -0,0 +1,227 @@
+"""
+生成結果の書き出し（ストアへの取り込み用の JSONL / HTMLファイルのzip / SQLite）
+
+    with open_exporter("export.zip") as exporter:
+        export_records(jobstore.JobStore().jobs("done"), exporter)
+
+- 1件ずつ書き出すため、件数が多くてもメモリ使用量は一定
+- どの形式も追記できるので、一括生成の実行中に完了した分から書き出せる
+  （JSONL は追記、zip と SQLite は商品ごとに置き換える）
+"""
+import json
+import os
+import re
+import shutil
+import sqlite3
+import zipfile
+
+import jobstore
+from postprocess import clean_html_tags, extract_fields, parse_generated_content
+
+# ストアへの取り込み形式の列（SQLite のテーブルと JSONL のキー）
+EXPORT_COLUMNS = [
+    "product_name",
+    "title",
+    "h1",
+    "description",
+    "html",
+    "reviews",
+    "references",
+    "image_abstract",
+    "image_person",
+    "model",
+    "finished_at",
+]
+
+def export_row(job_or_record):
+    """
+    ジョブ（jobstore）または bulk の出力レコードを、取り込み形式の1行（辞書）に変換する
+
+    reviews / references はリスト（JSON）で持つ。HTML は属性を削除済みのものを使う
+    """
+    if "sections" in job_or_record and "record" in job_or_record:
+        record = jobstore.job_record(job_or_record)
+        if not job_or_record["sections"] and job_or_record.get("raw_response"):
+            # セクションを保存していない結果（アプリで保存したもの）は生の応答から取り出す
+            record.update(parse_generated_content(job_or_record["raw_response"]))
+        record.setdefault("product_name", job_or_record["product_name"])
+        finished_at = job_or_record.get("finished_at")
+    else:
+        record = job_or_record
+        finished_at = record.get("finished_at")
+    fields = record.get("fields") or extract_fields(record)
+    return {
+        "product_name": record["product_name"],
+        "title": fields["title"],
+        "h1": fields["h1"],
+        "description": fields["description"],
+        "html": clean_html_tags(record.get("html_content", "")),
+        "reviews": fields["reviews"] or [],
+        "references": fields["references"],
+        "image_abstract": fields["image_abstract"],
+        "image_person": fields["image_person"],
+        "model": record.get("model"),
+        "finished_at": finished_at,
+    }
+
+def iter_jsonl(path):
+    """
+    bulk run の出力JSONLから、エラーでないレコードを1件ずつ返す
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "error" not in record:
+                yield record
+
+class JSONLExporter:
+    """
+    1商品1行のJSONLに追記する
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, row):
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ZipExporter(JSONLExporter):
+    """
+    商品ごとに <商品名>.html（本文）と <商品名>.json（本文以外の項目）をzipに書き出す
+
+    既存のzipに書き出す場合は、今回書き出した商品のファイルを置き換え、それ以外の商品のファイルは
+    そのまま残したzipを一時ファイルに作り直して、閉じるときに差し替える（再書き出しで商品が重複しない）。
+    ファイル名の持ち主は既存のzipの <名前>.json の product_name から引き継ぐので、
+    同じファイル名になる別の商品の連番（-2 など）も前回と同じになる
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        self._owners = self._existing_owners(path)
+        self._written = set()
+        self._file = zipfile.ZipFile(self._tmp_path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    @staticmethod
+    def _existing_owners(path):
+        # 既存のzipの {ファイル名（拡張子なし）: 商品名}
+        owners = {}
+        if not os.path.exists(path):
+            return owners
+        with zipfile.ZipFile(path) as old:
+            for filename in old.namelist():
+                if filename.endswith(".json"):
+                    owners[filename[:-len(".json")]] = json.loads(old.read(filename)).get("product_name")
+        return owners
+
+    def _name(self, product_name):
+        # 別の商品が同じファイル名になる場合だけ連番を付ける（同じ商品は常に同じファイル名）
+        base = safe_filename(product_name)
+        name, number = base, 1
+        while self._owners.setdefault(name, product_name) != product_name:
+            number += 1
+            name = f"{base}-{number}"
+        return name
+
+    def write(self, row):
+        name = self._name(row["product_name"])
+        self._written.add(name)
+        self._file.writestr(f"{name}.html", row["html"])
+        meta = {key: value for key, value in row.items() if key != "html"}
+        self._file.writestr(f"{name}.json", json.dumps(meta, ensure_ascii=False, indent=2))
+
+    def close(self):
+        written = {f"{name}.{ext}" for name in self._written for ext in ("html", "json")}
+        if os.path.exists(self.path):
+            with zipfile.ZipFile(self.path) as old:
+                for info in old.infolist():
+                    if info.filename not in written:
+                        with old.open(info) as src, self._file.open(info, "w") as dst:
+                            shutil.copyfileobj(src, dst)
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+class SQLiteExporter(JSONLExporter):
+    """
+    products テーブルに商品名をキーとして書き込む（再度書き出した商品は上書き）
+    """
+
+    def __init__(self, path, table="products"):
+        self.path = path
+        self.table = table
+        self._file = sqlite3.connect(path)
+        # references は SQL の予約語なので列名は引用符で囲む
+        columns = ", ".join(
+            f'"{name}" TEXT PRIMARY KEY' if name == "product_name" else f'"{name}" {"REAL" if name == "finished_at" else "TEXT"}'
+            for name in EXPORT_COLUMNS
+        )
+        self._file.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        self._pending = 0
+
+    def write(self, row):
+        values = [
+            json.dumps(row[name], ensure_ascii=False) if isinstance(row[name], (list, dict)) else row[name]
+            for name in EXPORT_COLUMNS
+        ]
+        columns = ", ".join(f'"{name}"' for name in EXPORT_COLUMNS)
+        placeholders = ", ".join("?" for _ in EXPORT_COLUMNS)
+        self._file.execute(f"INSERT OR REPLACE INTO {self.table} ({columns}) VALUES ({placeholders})", values)
+        # 一定件数ごとにコミットして、書き出し中でも他のプロセスから読めるようにする
+        self._pending += 1
+        if self._pending >= 100:
+            self._file.commit()
+            self._pending = 0
+
+    def close(self):
+        self._file.commit()
+        self._file.close()
+
+EXPORTERS = {
+    "jsonl": JSONLExporter,
+    "zip": ZipExporter,
+    "sqlite": SQLiteExporter,
+}
+
+def detect_format(path):
+    """
+    出力先の拡張子から形式を判定する（.zip / .sqlite・.sqlite3・.db / それ以外は jsonl）
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".zip":
+        return "zip"
+    if ext in (".sqlite", ".sqlite3", ".db"):
+        return "sqlite"
+    return "jsonl"
+
+def open_exporter(path, fmt=None):
+    return EXPORTERS[fmt or detect_format(path)](path)
+
+def safe_filename(name):
+    """
+    商品名をファイル名に使える文字列にする（日本語はそのまま残す）
+    """
+    name = re.sub(r'[\\/:*?"<>|\s]+', "_", name).strip("._")
+    return name[:100] or "product"
+
+def export_records(records, exporter):
+    """
+    レコード（ジョブまたは bulk の出力レコード）を1件ずつ書き出し、件数を返す
+    """
+    count = 0
+    for record in records:
+        exporter.write(export_row(record))
+        count += 1
+    return count
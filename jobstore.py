@@ -0,0 +1,398 @@
+"""
+一括生成ジョブの永続ストア（SQLite）
+
+商品ごとに状態・入力・生成結果・試行回数を保存し、中断しても続きから再開できるようにする。
+
+状態の遷移:
+    pending → scraping → generating → done
+                                    → pending（失敗、試行回数が上限未満なら再試行）
+                                    → failed（試行回数の上限に達した失敗。デッドレター）
+
+- 複数のプロセスから同じファイルを共有できる（claim は排他的に1件ずつ取り出す）
+- scraping / generating のまま STALE_AFTER 秒更新が無いジョブは、異常終了したものとして recover で pending に戻す
+- 保存先は環境変数 LPGEN_JOB_DB で変更できる
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from postprocess import SECTION_KEYS, compose_generated_content, extract_fields, parse_generated_content
+
+JOB_DB = os.getenv("LPGEN_JOB_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3"))
+
+# 1商品あたりの最大試行回数
+MAX_ATTEMPTS = 3
+# 処理中のまま更新が止まったジョブを再取得するまでの秒数
+STALE_AFTER = 15 * 60
+# スループットを計算する直近の時間幅（秒）
+THROUGHPUT_WINDOW = 10 * 60
+
+STATES = ("pending", "scraping", "generating", "done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    product_name TEXT NOT NULL UNIQUE,
+    input TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    raw_response TEXT,
+    sections TEXT,
+    record TEXT,
+    fingerprint TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, attempts, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (finished_at);
+"""
+
+# 作成済みのデータベースに後から追加した列
+_ADDED_COLUMNS = {"fingerprint": "TEXT"}
+
+class JobStore:
+    """
+    商品ごとの生成ジョブを保存する SQLite ストア
+    """
+
+    def __init__(self, path=None, max_attempts=MAX_ATTEMPTS, stale_after=STALE_AFTER):
+        self.path = path or JOB_DB
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for name, column_type in _ADDED_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def enqueue(self, products):
+        """
+        商品リストをジョブとして登録する（登録済みの商品名は無視する）。追加した件数を返す
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (product_name, input, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                [(p["product_name"], json.dumps(p, ensure_ascii=False), now, now) for p in products],
+            )
+            added = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def update_inputs(self, products):
+        """
+        登録済みの商品の入力（URL・特記事項）を更新し、未登録の商品は追加する。追加した件数を返す
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.executemany(
+                "UPDATE jobs SET input = ?, updated_at = ? WHERE product_name = ?",
+                [(json.dumps(p, ensure_ascii=False), now, p["product_name"]) for p in products],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self.enqueue(products)
+
+    def requeue(self, job_ids):
+        """
+        指定したジョブを試行回数0の pending に戻す（再生成する）。戻した件数を返す
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE jobs SET state = 'pending', attempts = 0, finished_at = NULL, updated_at = ? WHERE id = ?",
+                [(now, job_id) for job_id in job_ids],
+            )
+            count = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def recover(self):
+        """
+        処理中のまま stale_after 秒以上更新が無いジョブ（異常終了したもの）を pending に戻す。戻した件数を返す
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET state = 'pending', updated_at = ? "
+            "WHERE state IN ('scraping', 'generating') AND updated_at <= ?",
+            (now, now - self.stale_after),
+        )
+        return cursor.rowcount
+
+    def touch(self, job_ids):
+        """
+        処理中のジョブの更新時刻を進める（バッチ予測の完了待ちのように長く処理中のままのジョブを recover で戻さない）
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.executemany(
+                "UPDATE jobs SET updated_at = ? WHERE id = ? AND state IN ('scraping', 'generating')",
+                [(now, job_id) for job_id in job_ids],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def claim(self):
+        """
+        次に処理する pending のジョブを1件取り出して scraping にする（無ければNone）
+        """
+        now = time.time()
+        conn = self._transaction()
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE state = 'pending' ORDER BY attempts, id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = 'scraping', attempts = attempts + 1, "
+                    "started_at = COALESCE(started_at, ?), updated_at = ? WHERE id = ?",
+                    (now, now, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job = self._job(row)
+        job["state"] = "scraping"
+        job["attempts"] += 1
+        return job
+
+    def set_state(self, job_id, state):
+        if state not in STATES:
+            raise ValueError(f"unknown job state: {state}")
+        self._connect().execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), job_id)
+        )
+
+    def complete(self, job_id, record):
+        """
+        生成結果を保存して done にする（record の fingerprint も保存する）
+        """
+        raw_response, sections, rest = _split_record(record)
+        now = time.time()
+        self._connect().execute(
+            "UPDATE jobs SET state = 'done', last_error = NULL, raw_response = ?, sections = ?, record = ?, "
+            "fingerprint = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+            (raw_response, sections, rest, record.get("fingerprint"), now, now, job_id),
+        )
+
+    def fail(self, job_id, error, record=None):
+        """
+        失敗を記録する。試行回数が上限未満なら pending に戻し、上限に達したら failed にする
+
+        戻り値: 再試行する場合は True
+        """
+        raw_response, _, rest = _split_record(record or {})
+        now = time.time()
+        conn = self._transaction()
+        try:
+            attempts = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+            retry = attempts < self.max_attempts
+            conn.execute(
+                "UPDATE jobs SET state = ?, last_error = ?, raw_response = COALESCE(?, raw_response), "
+                "record = COALESCE(?, record), updated_at = ?, finished_at = ? WHERE id = ?",
+                ("pending" if retry else "failed", str(error)[:2000], raw_response, rest, now,
+                 None if retry else now, job_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return retry
+
+    def save(self, product, record):
+        """
+        アプリなどで個別に生成した結果を done のジョブとして保存する（同じ商品名は上書き）
+        """
+        self.enqueue([product])
+        raw_response, sections, rest = _split_record(record)
+        now = time.time()
+        self._connect().execute(
+            "UPDATE jobs SET input = ?, state = 'done', last_error = NULL, raw_response = ?, sections = ?, "
+            "record = ?, fingerprint = ?, updated_at = ?, started_at = COALESCE(started_at, ?), finished_at = ? "
+            "WHERE product_name = ?",
+            (json.dumps(product, ensure_ascii=False), raw_response, sections, rest, record.get("fingerprint"),
+             now, now, now, product["product_name"]),
+        )
+
+    def update_section(self, product_name, section, value):
+        """
+        保存済みの生成結果のうち1つのセクションだけを置き換え、raw_response も組み立て直す。更新後のレコードを返す
+        """
+        job = self.find(product_name)
+        if job is None or job["state"] != "done":
+            raise KeyError(f"no finished job for {product_name}")
+        record = job_record(job)
+        if not job["sections"]:
+            # セクションを保存していない結果（アプリで保存したもの）は生の応答から取り出す
+            record.update(parse_generated_content(job["raw_response"] or ""))
+        record[section] = value
+        record["raw_response"] = compose_generated_content(record)
+        record["fields"] = extract_fields({key: record.get(key, "") for key in SECTION_KEYS})
+        self.save(job["product"], record)
+        return record
+
+    def requeue_failed(self):
+        """
+        デッドレター（failed）のジョブを試行回数0の pending に戻す。戻した件数を返す
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET state = 'pending', attempts = 0, finished_at = NULL, updated_at = ? WHERE state = 'failed'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def find(self, product_name):
+        row = self._connect().execute("SELECT * FROM jobs WHERE product_name = ?", (product_name,)).fetchone()
+        return self._job(row) if row else None
+
+    def recent(self, state="done", limit=50):
+        """
+        指定した状態のジョブの商品名を、更新が新しい順に返す
+        """
+        rows = self._connect().execute(
+            "SELECT product_name FROM jobs WHERE state = ? ORDER BY updated_at DESC LIMIT ?", (state, limit)
+        )
+        return [row["product_name"] for row in rows]
+
+    def jobs(self, state=None, finished_after=None):
+        """
+        ジョブを登録順に1件ずつ返す（state を指定するとその状態のみ）
+
+        finished_after を指定すると、その時刻より後に完了・失敗したジョブを完了順に返す
+        """
+        conn = self._connect()
+        if finished_after is not None:
+            query = "SELECT * FROM jobs WHERE finished_at > ?" + (" AND state = ?" if state else "") + " ORDER BY finished_at"
+            rows = conn.execute(query, (finished_after, state) if state else (finished_after,))
+        elif state:
+            rows = conn.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,))
+        else:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY id")
+        for row in rows:
+            yield self._job(row)
+
+    def dead_letters(self):
+        """
+        試行回数の上限に達して失敗したジョブの一覧
+        """
+        return [
+            {"id": job["id"], "product_name": job["product_name"], "attempts": job["attempts"], "error": job["last_error"]}
+            for job in self.jobs("failed")
+        ]
+
+    def progress(self, window=THROUGHPUT_WINDOW):
+        """
+        状態ごとの件数と、直近 window 秒の完了件数から計算したスループット（件/分）・残り時間の見込みを返す
+        """
+        now = time.time()
+        conn = self._connect()
+        counts = dict.fromkeys(STATES, 0)
+        for row in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"):
+            counts[row["state"]] = row["n"]
+        total = sum(counts.values())
+        # 処理を始めてから window 秒経っていなければ、開始からの経過時間で割る
+        first_started = conn.execute("SELECT MIN(started_at) FROM jobs").fetchone()[0]
+        elapsed = min(window, now - first_started) if first_started else 0.0
+        finished = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE finished_at >= ?", (now - elapsed,)
+        ).fetchone()[0]
+        per_minute = finished / elapsed * 60 if finished and elapsed > 0 else 0.0
+        remaining = total - counts["done"] - counts["failed"]
+        return {
+            "total": total,
+            **counts,
+            "remaining": remaining,
+            "products_per_minute": round(per_minute, 2),
+            "eta_sec": round(remaining / per_minute * 60, 1) if per_minute else None,
+        }
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job["product"] = json.loads(job.pop("input"))
+        for key in ("sections", "record"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+def get_job_store():
+    """
+    既定の保存先（JOB_DB）のジョブストアを返す
+    """
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = JobStore()
+        return _job_store
+
+def _split_record(record):
+    """
+    出力レコードを (生の応答, セクションのJSON, それ以外のJSON) に分ける
+    """
+    if not record:
+        return None, None, None
+    rest = {k: v for k, v in record.items() if k != "raw_response" and k not in SECTION_KEYS}
+    sections = {k: record[k] for k in SECTION_KEYS if k in record}
+    return (
+        record.get("raw_response"),
+        json.dumps(sections, ensure_ascii=False) if sections else None,
+        json.dumps(rest, ensure_ascii=False, default=str),
+    )
+
+def job_record(job):
+    """
+    保存済みのジョブから bulk run の出力と同じ形のレコードを組み立てる
+    """
+    record = dict(job.get("record") or {})
+    record.update(job.get("sections") or {})
+    if job.get("raw_response") is not None:
+        record["raw_response"] = job["raw_response"]
+    return record
@@ -0,0 +1,261 @@
+"""
+生成パイプラインの計測（処理区間ごとの所要時間・取得バイト数・トークン数など）
+
+    with metrics.start_run("bulk", product="A") as run:
+        with metrics.span("scrape.fetch", url=url) as s:
+            ...
+            s["bytes"] = len(body)
+    run.summary()  # 区間名ごとの合計時間
+
+- 終了した区間は1行1件のJSONLとして LOG_DIR/spans.jsonl に追記する
+  （SPANS_MAX_BYTES を超えたら spans.jsonl.1 〜 spans.jsonl.<SPANS_BACKUPS> に送り、最も古いものは削除する）
+- 集計値は Prometheus のテキスト形式で LOG_DIR/metrics.prom に書き出す。各プロセスは自分の集計値を
+  LOG_DIR/metrics.d/<pid>-<乱数>.json に保存し、metrics.prom には全プロセス（終了したものを含む）の合計を書く
+  （bulk の複数プロセスと app が並行しても、新しいプロセスが起動しても合計は減らない）
+- 保存先は環境変数 LPGEN_LOG_DIR、LPGEN_METRICS=0 でファイル出力を無効化できる
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+LOG_DIR = os.getenv("LPGEN_LOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs"))
+ENABLED = os.getenv("LPGEN_METRICS", "1") != "0"
+
+# spans.jsonl の上限サイズ（バイト）と、ローテーションで残す古いファイルの数
+SPANS_MAX_BYTES = int(os.getenv("LPGEN_SPANS_MAX_BYTES", 50 * 1024 * 1024))
+SPANS_BACKUPS = 3
+
+# 区間の属性のうち、合計値として Prometheus に出力するもの
+COUNTED_ATTRS = ["bytes", "prompt_tokens", "response_tokens", "retries", "throttled", "rate_limit_wait_sec"]
+
+_current_run = contextvars.ContextVar("lpgen_run", default=None)
+_current_span = contextvars.ContextVar("lpgen_span", default=None)
+
+_write_lock = threading.Lock()
+_totals_lock = threading.Lock()
+_totals = {}
+_model_totals = {}
+# metrics.d に保存するこのプロセスの集計値のファイル名（pid が再利用されても別のプロセスと混ざらないよう乱数を付ける）
+_PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+class Run:
+    """
+    1回の生成（1商品分）に含まれる区間をまとめる
+    """
+
+    def __init__(self, name, **attrs):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def summary(self):
+        """
+        区間名ごとの回数・合計時間（ミリ秒）と、主な属性の合計を返す
+        """
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        for record in spans:
+            stage = stages.setdefault(record["name"], {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] = round(stage["total_ms"] + record["duration_ms"], 1)
+            for attr in COUNTED_ATTRS:
+                if isinstance(record.get(attr), (int, float)):
+                    stage[attr] = stage.get(attr, 0) + record[attr]
+            if record.get("model"):
+                stage["model"] = record["model"]
+        return stages
+
+@contextmanager
+def start_run(name, **attrs):
+    """
+    計測単位（run）を開始する。中で記録した区間は run_id 付きで保存される
+    """
+    run = Run(name, **attrs)
+    token = _current_run.set(run)
+    try:
+        with span(name, **attrs):
+            yield run
+    finally:
+        _current_run.reset(token)
+        write_prometheus()
+
+@contextmanager
+def span(name, **attrs):
+    """
+    処理区間の所要時間を計測する。yield される辞書に属性を追加できる
+    """
+    parent = _current_span.get()
+    record = {"name": name, **attrs}
+    token = _current_span.set(record)
+    started = time.perf_counter()
+    record["started_at"] = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = str(e)[:500]
+        raise
+    finally:
+        _current_span.reset(token)
+        record["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        run = _current_run.get()
+        record["run_id"] = run.run_id if run else None
+        record["parent"] = parent["name"] if parent else None
+        if run:
+            run.add(record)
+        _accumulate(record)
+        _write_span(record)
+
+def record_span(name, started_at, **attrs):
+    """
+    started_at（time.time() の値）から現在までを1つの区間として記録する
+    （with で囲めないジェネレーターなどで使う）
+    """
+    parent = _current_span.get()
+    run = _current_run.get()
+    record = {"name": name, **attrs}
+    record["started_at"] = started_at
+    record["duration_ms"] = round((time.time() - started_at) * 1000, 2)
+    record["run_id"] = run.run_id if run else None
+    record["parent"] = parent["name"] if parent else None
+    if run:
+        run.add(record)
+    _accumulate(record)
+    _write_span(record)
+    return record
+
+def current_run():
+    return _current_run.get()
+
+def _accumulate(record):
+    with _totals_lock:
+        total = _totals.setdefault(record["name"], {"count": 0, "seconds": 0.0, "errors": 0})
+        total["count"] += 1
+        total["seconds"] += record["duration_ms"] / 1000
+        if "error" in record:
+            total["errors"] += 1
+        for attr in COUNTED_ATTRS:
+            if isinstance(record.get(attr), (int, float)):
+                total[attr] = total.get(attr, 0) + record[attr]
+        if record.get("model") and not record.get("cached") and record["name"] in ("generate", "generate.stream", "generate.section"):
+            _model_totals[record["model"]] = _model_totals.get(record["model"], 0) + 1
+
+def _write_span(record):
+    if not ENABLED:
+        return
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    path = os.path.join(LOG_DIR, "spans.jsonl")
+    with _write_lock:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            size = f.tell()
+        if size >= SPANS_MAX_BYTES:
+            _rotate_spans(path)
+
+def _rotate_spans(path):
+    """
+    spans.jsonl を spans.jsonl.1 に、spans.jsonl.1 を spans.jsonl.2 に…と送る
+
+    別のプロセスが先にローテーションした場合はファイルが無いことがあるので、その場合は何もしない
+    """
+    try:
+        for i in range(SPANS_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}"):
+                os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+        os.replace(path, f"{path}.1")
+    except FileNotFoundError:
+        pass
+
+def prometheus_text(totals=None, models=None):
+    """
+    集計値を Prometheus のテキスト形式で返す（省略時はこのプロセスの集計値）
+    """
+    if totals is None:
+        totals, models = _snapshot()
+
+    lines = [
+        "# HELP lpgen_stage_seconds_total Time spent in each pipeline stage.",
+        "# TYPE lpgen_stage_seconds_total counter",
+    ]
+    lines += [f'lpgen_stage_seconds_total{{stage="{name}"}} {v["seconds"]:.6f}' for name, v in sorted(totals.items())]
+    lines += [
+        "# HELP lpgen_stage_calls_total Number of times each pipeline stage ran.",
+        "# TYPE lpgen_stage_calls_total counter",
+    ]
+    lines += [f'lpgen_stage_calls_total{{stage="{name}"}} {v["count"]}' for name, v in sorted(totals.items())]
+    lines += [
+        "# HELP lpgen_stage_errors_total Number of failed runs of each pipeline stage.",
+        "# TYPE lpgen_stage_errors_total counter",
+    ]
+    lines += [f'lpgen_stage_errors_total{{stage="{name}"}} {v["errors"]}' for name, v in sorted(totals.items())]
+    for attr in COUNTED_ATTRS:
+        lines += [f"# TYPE lpgen_{attr}_total counter"]
+        lines += [
+            f'lpgen_{attr}_total{{stage="{name}"}} {v[attr]}'
+            for name, v in sorted(totals.items()) if attr in v
+        ]
+    lines += [
+        "# HELP lpgen_model_generations_total Successful generations per model.",
+        "# TYPE lpgen_model_generations_total counter",
+    ]
+    lines += [f'lpgen_model_generations_total{{model="{model}"}} {count}' for model, count in sorted(models.items())]
+    return "\n".join(lines) + "\n"
+
+def _snapshot():
+    with _totals_lock:
+        return {name: dict(values) for name, values in _totals.items()}, dict(_model_totals)
+
+def _merge_process_totals(state_dir):
+    """
+    metrics.d の全プロセスの集計値を合計する
+    """
+    totals, models = {}, {}
+    for filename in os.listdir(state_dir):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(state_dir, filename), encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, values in state["stages"].items():
+            total = totals.setdefault(name, {})
+            for key, value in values.items():
+                total[key] = total.get(key, 0) + value
+        for model, count in state["models"].items():
+            models[model] = models.get(model, 0) + count
+    return totals, models
+
+def _replace_file(path, text):
+    # 一時ファイルに書いてから置き換える（読み手が書きかけのファイルを見ないように）
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def write_prometheus():
+    """
+    このプロセスの集計値を LOG_DIR/metrics.d に保存し、全プロセスの合計を LOG_DIR/metrics.prom に書き出す
+    """
+    if not ENABLED:
+        return
+    totals, models = _snapshot()
+    with _write_lock:
+        state_dir = os.path.join(LOG_DIR, "metrics.d")
+        os.makedirs(state_dir, exist_ok=True)
+        _replace_file(
+            os.path.join(state_dir, f"{_PROCESS_ID}.json"),
+            json.dumps({"stages": totals, "models": models}, ensure_ascii=False),
+        )
+        _replace_file(os.path.join(LOG_DIR, "metrics.prom"), prometheus_text(*_merge_process_totals(state_dir)))
@@ -0,0 +1,274 @@
+import json
+import re
+
+# 属性を削除する対象のタグ（h2-h6, table, ul, ol）
+# - 属性は「名前」「名前=値」の単位でマッチさせる。値は "..." / '...' / 引用符無しのいずれかで、
+#   引用符で囲まれた値の中の ">" や、引用符無しの値に含まれる "'" でタグの終わりを誤認しない
+# - re.IGNORECASE は走査が遅くなるため、大文字小文字は文字クラスで表現する
+_ATTR_TAG_PATTERN = re.compile(
+    r"<([hH][2-6]|[tT][aA][bB][lL][eE]|[uU][lL]|[oO][lL])(?=\s)"
+    r"""(?:\s+[^\s=>]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>]+))?)*\s*/?>"""
+)
+
+def _strip_attributes(match):
+    return f"<{match.group(1).lower()}>"
+
+def clean_html_tags(html_content):
+    """
+    指定されたタグ（h2-h6, table, ul, ol）から属性（style, class等）を強制的に削除する
+
+    例: <h2 style="..."> -> <h2> (閉じタグはそのまま)
+    全タグを1回の走査で置換する
+    """
+    return _ATTR_TAG_PATTERN.sub(_strip_attributes, html_content)
+
+def parse_generated_content(text):
+    """
+    生成されたテキストから各セクションを抽出する
+
+    構造化出力（RESPONSE_SCHEMA に沿ったJSON）の場合は parse_structured_content で読み込む
+    """
+    # エラーチェック
+    if text.startswith("Error:"):
+        return {"error": text}
+
+    if text.lstrip().startswith("{"):
+        return parse_structured_content(text)
+
+    sections = {}
+
+    # 正規表現でタグの中身を抽出
+    patterns = {
+        "metadata": r"<metadata>(.*?)</metadata>",
+        "html_content": r"<html_content>(.*?)</html_content>",
+        "reviews": r"<reviews>(.*?)</reviews>",
+        "references": r"<references>(.*?)</references>"
+    }
+
+    for key, pattern in patterns.items():
+        match = re.search(pattern, text, re.DOTALL)
+        if match:
+            sections[key] = match.group(1).strip()
+        else:
+            sections[key] = ""
+
+    return sections
+
+SECTION_KEYS = ["metadata", "html_content", "reviews", "references"]
+
+def compose_generated_content(sections):
+    """
+    セクションの辞書を parse_generated_content で読み戻せるテキストに組み立てる
+    （一部のセクションだけを再生成した結果を保存するときに使う）
+    """
+    return "\n\n".join(f"<{key}>\n{sections.get(key, '')}\n</{key}>" for key in SECTION_KEYS)
+
+class IncrementalSectionParser:
+    """
+    ストリーミング中のテキストを受け取り、閉じタグが届いたセクションから順に取り出すパーサー
+
+    受信済みの部分は再走査しないため、チャンク数が多くても全体で1回分の走査で済む
+    """
+
+    def __init__(self, keys=SECTION_KEYS):
+        self.keys = list(keys)
+        self.buffer = ""
+        self.sections = {}
+        self._open_end = {}
+
+    def feed(self, chunk):
+        """
+        チャンクを追加し、新たに完成した (キー, 内容) のリストを返す
+        """
+        prev_len = len(self.buffer)
+        self.buffer += chunk
+        completed = []
+        for key in self.keys:
+            if key in self.sections:
+                continue
+            open_tag = f"<{key}>"
+            close_tag = f"</{key}>"
+            if key not in self._open_end:
+                idx = self.buffer.find(open_tag, max(0, prev_len - len(open_tag)))
+                if idx < 0:
+                    continue
+                self._open_end[key] = idx + len(open_tag)
+                search_from = self._open_end[key]
+            else:
+                search_from = max(self._open_end[key], prev_len - len(close_tag))
+            end = self.buffer.find(close_tag, search_from)
+            if end < 0:
+                continue
+            self.sections[key] = self.buffer[self._open_end[key]:end].strip()
+            completed.append((key, self.sections[key]))
+        return completed
+
+    def result(self):
+        """
+        parse_generated_content と同じ形式で結果を返す（未完成のセクションは空文字）
+        """
+        if self.buffer.startswith("Error:"):
+            return {"error": self.buffer}
+        return {key: self.sections.get(key, "") for key in self.keys}
+
+# 構造化出力で生成させるJSONのスキーマ（JSON Schema）
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "metadata": {
+            "type": "object",
+            "properties": {
+                "title": {"type": "string", "description": "推奨タイトル（32文字以内）"},
+                "h1": {"type": "string", "description": "ページ内の大見出しテキスト"},
+                "description": {"type": "string", "description": "クリック率重視のディスクリプション"},
+                "image_abstract": {"type": "string", "description": "抽象イメージ（効果・悩み解決）の画像生成プロンプト"},
+                "image_person": {"type": "string", "description": "人物イメージ（信頼感・笑顔）の画像生成プロンプト"},
+            },
+            "required": ["title", "h1", "description"],
+        },
+        "html_content": {"type": "string", "description": "商品詳細ページのHTML（<body>の中身のみ）"},
+        "reviews": {
+            "type": "array",
+            "description": "ユーザーレビュー（10件程度）",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "date": {"type": "string"},
+                    "rating": {"type": "integer"},
+                    "title": {"type": "string"},
+                    "body": {"type": "string"},
+                },
+                "required": ["name", "date", "rating", "title", "body"],
+            },
+        },
+        "references": {
+            "type": "array",
+            "description": "権威性担保のための信頼できる情報源（公的機関、製薬会社など。競合サイトは含めない）",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "url": {"type": "string"},
+                },
+                "required": ["name", "url"],
+            },
+        },
+    },
+    "required": ["metadata", "html_content", "reviews", "references"],
+}
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+def validate_schema(value, schema, path="$"):
+    """
+    value が schema（RESPONSE_SCHEMA で使っている範囲の JSON Schema）に沿っているか検証し、
+    違反の一覧を返す（空なら妥当）
+    """
+    expected = _JSON_TYPES[schema["type"]]
+    if not isinstance(value, expected) or (schema["type"] == "integer" and isinstance(value, bool)):
+        return [f"{path}: expected {schema['type']}"]
+    errors = []
+    if schema["type"] == "object":
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors += validate_schema(value[key], sub_schema, f"{path}.{key}")
+    elif schema["type"] == "array":
+        for index, item in enumerate(value):
+            errors += validate_schema(item, schema["items"], f"{path}[{index}]")
+    return errors
+
+def parse_structured_content(text):
+    """
+    構造化出力のJSONを1回の読み込みと検証で parse_generated_content と同じ形式に変換する
+
+    各セクションは従来と同じ文字列形式で返し、型付きの値は "fields" に入れる
+    """
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        return {"error": f"Error: 構造化出力のJSONを読み込めませんでした ({e})"}
+    errors = validate_schema(data, RESPONSE_SCHEMA)
+    if errors:
+        return {"error": "Error: 構造化出力がスキーマに一致しません: " + "; ".join(errors[:5])}
+
+    meta = data["metadata"]
+    fields = {
+        "title": meta["title"].strip(),
+        "h1": meta["h1"].strip(),
+        "description": meta["description"].strip(),
+        "image_abstract": meta.get("image_abstract", "").strip(),
+        "image_person": meta.get("image_person", "").strip(),
+        "reviews": data["reviews"],
+        "references": data["references"],
+    }
+    return {
+        "metadata": format_metadata(fields),
+        "html_content": data["html_content"].strip(),
+        "reviews": json.dumps(data["reviews"], ensure_ascii=False, indent=2),
+        "references": "\n".join(f"- [{ref['name']}]({ref['url']})" for ref in data["references"]),
+        "fields": fields,
+    }
+
+def format_metadata(fields):
+    """
+    型付きのメタデータを、タグ形式の <metadata> と同じテキストに整形する
+    """
+    lines = [
+        f"Recommended Title: {fields['title']}",
+        f"Recommended H1: {fields['h1']}",
+        f"Recommended Description: {fields['description']}",
+    ]
+    if fields.get("image_abstract") or fields.get("image_person"):
+        lines.append("Image Prompts:")
+        lines.append(f"- [Abstract]: {fields.get('image_abstract', '')}")
+        lines.append(f"- [Person]: {fields.get('image_person', '')}")
+    return "\n".join(lines)
+
+_METADATA_PATTERNS = {
+    "title": re.compile(r"Recommended Title:\s*(.*)"),
+    "h1": re.compile(r"Recommended H1:\s*(.*)"),
+    "description": re.compile(r"Recommended Description:\s*(.*)"),
+    "image_abstract": re.compile(r"(?:-|\*)\s*(?:\*\*)?\[Abstract\](?:\*\*)?:?\s*(.*)", re.IGNORECASE),
+    "image_person": re.compile(r"(?:-|\*)\s*(?:\*\*)?\[Person\](?:\*\*)?:?\s*(.*)", re.IGNORECASE),
+}
+_REFERENCE_PATTERN = re.compile(r"\[([^\]]+)\]\((\S+?)\)")
+
+def parse_metadata(metadata_text):
+    """
+    タグ形式の <metadata> のテキストからタイトル・H1・ディスクリプション・画像プロンプトを取り出す
+    """
+    fields = {}
+    for key, pattern in _METADATA_PATTERNS.items():
+        match = pattern.search(metadata_text)
+        fields[key] = match.group(1).strip() if match else ""
+    return fields
+
+def extract_fields(parsed):
+    """
+    パース結果から型付きの値（メタデータの各項目・レビューのリスト・参考リンクのリスト）を返す
+
+    構造化出力の結果は "fields" をそのまま返す。レビューのJSONが読み込めない場合、"reviews" は None
+    """
+    if "fields" in parsed:
+        return parsed["fields"]
+    fields = parse_metadata(parsed.get("metadata", ""))
+    try:
+        reviews = json.loads(parsed.get("reviews", ""))
+    except ValueError:
+        reviews = None
+    fields["reviews"] = reviews if isinstance(reviews, list) else None
+    fields["references"] = [
+        {"name": name, "url": url} for name, url in _REFERENCE_PATTERN.findall(parsed.get("references", ""))
+    ]
+    return fields
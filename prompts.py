@@ -1,7 +1,16 @@
-from google import genai
-from google.genai import types
 import base64
+import contextvars
+import itertools
 import os
+import re
+import threading
+import time
+import cache
+import context
+import metrics
+import ratelimit
+from postprocess import RESPONSE_SCHEMA, SECTION_KEYS, compose_generated_content, parse_structured_content
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # システムプロンプトの定義
 SYSTEM_INSTRUCTION = """
@@ -78,13 +87,176 @@ Recommended Description: [クリック率重視のディスクリプション]
 
 
 
-def generate_content(api_key, context_text, product_name, model_name=None):
+# モデル名の候補（ユーザー環境で確認されたモデルを優先）
+# 2026年現在の最新モデル群
+CANDIDATE_MODELS = [
+    "gemini-3-pro-preview",
+    "gemini-2.5-flash",
+    "gemini-2.0-flash",
+    "gemini-1.5-pro",
+    "gemini-1.5-flash",
+    "gemini-1.5-flash-8b"
+]
+
+# 一時的に使えないモデルを飛ばすまでの待機時間（秒）
+COOLDOWN_NOT_FOUND = 3600  # 404: 廃止・未提供のモデル
+COOLDOWN_TRANSIENT = 60    # 429 / 5xx: クォータ超過・サーバーエラー
+COOLDOWN_MAX = 3600
+
+# 429 を受けたとき、次のモデルに切り替える前に同じモデルで待機・再試行する回数
+RATE_LIMIT_RETRIES = 2
+# レート制限の枠が空くまで同じモデルで待つ最大秒数（超える場合は待たずに次のモデルに切り替える）
+MAX_RATE_LIMIT_WAIT = 30.0
+# TPM の枠を確保するときに見込む出力トークン数（実際の値は応答後に補正する）
+EXPECTED_RESPONSE_TOKENS = 8000
+
+# APIの接続先を差し替える場合（ローカルのスタブサーバーでのベンチマーク等）に指定する
+API_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key):
     """
-    Gemini API (google.genai) を呼び出してHTMLを生成する
+    APIキーごとに使い回す genai.Client を返す
+
+    google.genai の読み込みには時間がかかる（1秒近く）ため、最初にAPIを呼び出すときに読み込む
+    """
+    from google import genai
+    from google.genai import types
+
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            if API_BASE_URL:
+                client = genai.Client(api_key=api_key, http_options=types.HttpOptions(base_url=API_BASE_URL))
+            else:
+                client = genai.Client(api_key=api_key)
+            _clients[api_key] = client
+        return client
+
+def error_status(error):
+    """
+    例外からHTTPステータスコードを取り出す（不明な場合はNone）
+    """
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(code, int):
+        return code
+    return None
+
+class ModelCircuitBreaker:
+    """
+    モデルごとの失敗を記録し、直近で失敗したモデルを一定時間スキップするサーキットブレーカー
+
+    - 404 / 429 / 5xx で失敗したモデルは待機時間が過ぎるまで候補から外す
+    - 待機時間が過ぎたら再び試行し、また失敗したら待機時間を倍にする
+    - それ以外のエラー（APIキー不正など）はモデルの問題ではないため記録のみ行う
     """
-    client = genai.Client(api_key=api_key)
 
-    user_prompt = f"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _entry(self, model):
+        return self._stats.setdefault(model, {
+            "successes": 0,
+            "failures": 0,
+            "consecutive_failures": 0,
+            "skipped": 0,
+            "last_error": None,
+            "last_status": None,
+            "open_until": 0.0,
+            "cooldown": 0,
+        })
+
+    def order(self, candidates):
+        """
+        試行可能なモデルだけを元の順番で返す。全て待機中の場合は再開が早い順に全て返す
+        """
+        now = time.time()
+        allowed = []
+        with self._lock:
+            for model in candidates:
+                entry = self._stats.get(model)
+                if entry is None or entry["open_until"] <= now:
+                    allowed.append(model)
+                else:
+                    entry["skipped"] += 1
+            if not allowed:
+                allowed = sorted(candidates, key=lambda m: self._stats[m]["open_until"])
+        return allowed
+
+    def record_success(self, model):
+        with self._lock:
+            entry = self._entry(model)
+            entry["successes"] += 1
+            entry["consecutive_failures"] = 0
+            entry["open_until"] = 0.0
+            entry["cooldown"] = 0
+
+    def record_failure(self, model, error):
+        with self._lock:
+            entry = self._entry(model)
+            status = error_status(error)
+            entry["failures"] += 1
+            entry["consecutive_failures"] += 1
+            entry["last_error"] = str(error)[:500]
+            entry["last_status"] = status
+            if status == 404:
+                cooldown = COOLDOWN_NOT_FOUND
+            elif status == 429 or (status is not None and status >= 500):
+                cooldown = min(max(entry["cooldown"] * 2, COOLDOWN_TRANSIENT), COOLDOWN_MAX)
+            else:
+                return
+            entry["cooldown"] = cooldown
+            entry["open_until"] = time.time() + cooldown
+
+    def stats(self):
+        """
+        モデルごとの成功・失敗回数と待機状態を返す
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                model: {
+                    "successes": e["successes"],
+                    "failures": e["failures"],
+                    "consecutive_failures": e["consecutive_failures"],
+                    "skipped": e["skipped"],
+                    "last_error": e["last_error"],
+                    "last_status": e["last_status"],
+                    "open": e["open_until"] > now,
+                    "retry_in_sec": round(max(0.0, e["open_until"] - now), 1),
+                }
+                for model, e in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+circuit_breaker = ModelCircuitBreaker()
+
+def get_model_stats():
+    """
+    モデルごとの失敗統計を返す
+    """
+    return circuit_breaker.stats()
+
+def candidate_models(model_name=None):
+    """
+    試行するモデルの順番を返す（指定されたモデルがあれば最優先）
+    """
+    candidates = list(CANDIDATE_MODELS)
+    if model_name:
+        candidates = [model_name] + [m for m in candidates if m != model_name]
+    return candidates
+
+def build_user_prompt(context_text, product_name):
+    """
+    商品名と参考情報からユーザープロンプトを作成する
+    """
+    return f"""
     以下の情報を元に、商品「{product_name}」の詳細ページHTMLを作成してください。
     
     ## 参考情報（競合サイト等）
@@ -95,39 +267,423 @@ def generate_content(api_key, context_text, product_name, model_name=None):
     - HTMLはそのままコピペして使える品質に仕上げてください。
     """
 
-    # モデル名の候補（ユーザー環境で確認されたモデルを優先）
-    # 2026年現在の最新モデル群
-    candidates = [
-        "gemini-3-pro-preview",
-        "gemini-2.5-flash",
-        "gemini-2.0-flash",
-        "gemini-1.5-pro",
-        "gemini-1.5-flash",
-        "gemini-1.5-flash-8b"
-    ]
-    
-    # 指定されたモデルがあれば最優先で追加
-    if model_name:
-        candidates.insert(0, model_name)
-    
-    errors = []
+# セクションごとの追加指示（build_user_prompt の追加指示のうち、そのセクションに関係するもの）
+SECTION_NOTES = {
+    "html_content": "- HTMLはそのままコピペして使える品質に仕上げてください。",
+    "reviews": "- レビューは非常にリアルな日本語で作成し、JSONとしてそのまま読み込める形式で出力してください。",
+}
+
+def build_section_instruction(section):
+    """
+    SYSTEM_INSTRUCTION から、1つのセクションだけを生成させるシステムプロンプトを作る
+
+    役割・ターゲット設定・禁止事項はそのまま使い、出力形式はそのセクションのタグの部分だけに絞る
+    """
+    if section not in SECTION_KEYS:
+        raise ValueError(f"unknown section: {section}")
+    head, rest = SYSTEM_INSTRUCTION.split("### 2. 出力形式", 1)
+    _, prohibitions = rest.split("## 禁止事項", 1)
+    block = re.search(rf"<{section}>.*?</{section}>", rest, re.DOTALL).group(0)
+    return (
+        f"{head}### 2. 出力形式 (重要)\n"
+        f"以下のXMLライクなタグで囲んで、このセクションだけを出力してください。これ以外のテキストは含めないでください。\n\n"
+        f"{block}\n\n## 禁止事項{prohibitions}"
+    )
+
+# 構造化出力（response_json_schema）に対応していないモデル（前方一致）。これらはタグ形式で生成する
+STRUCTURED_OUTPUT_UNSUPPORTED = ("gemini-1.5",)
+
+def supports_structured_output(model):
+    return not model.startswith(STRUCTURED_OUTPUT_UNSUPPORTED)
+
+def build_structured_instruction():
+    """
+    SYSTEM_INSTRUCTION から、RESPONSE_SCHEMA に沿ったJSONで出力させるシステムプロンプトを作る
+
+    本文HTMLのルールはそのまま使い、タグ形式の出力指定はJSONのフィールドの説明に置き換える
+    """
+    head, rest = SYSTEM_INSTRUCTION.split("### 2. 出力形式", 1)
+    _, prohibitions = rest.split("## 禁止事項", 1)
+    html_rules = re.search(r"<html_content>(.*?)</html_content>", rest, re.DOTALL).group(1).strip()
+    return (
+        f"{head}### 2. 出力形式 (重要)\n"
+        f"指定されたJSONスキーマに沿って出力してください。各フィールドの内容はスキーマの説明に従ってください。\n\n"
+        f"#### html_content のルール\n{html_rules}\n\n"
+        f"#### reviews / references\n"
+        f"- reviews にはリアルな日本語のユーザーレビューを10件程度入れてください。\n"
+        f"- references には公的機関・製薬会社など信頼できる情報源を入れてください。競合サイトのURLは含めないでください。\n\n"
+        f"## 禁止事項{prohibitions}"
+    )
+
+def _generation_config(system_instruction, structured):
+    from google.genai import types
+
+    if structured:
+        return types.GenerateContentConfig(
+            system_instruction=build_structured_instruction(),
+            response_mime_type="application/json",
+            response_json_schema=RESPONSE_SCHEMA,
+        )
+    return types.GenerateContentConfig(system_instruction=system_instruction)
+
+def build_section_prompt(context_text, product_name, section, current_sections=None):
+    """
+    1つのセクションを生成するユーザープロンプトを作成する
+
+    current_sections に生成済みのセクションを渡すと、内容をそろえるためにメタデータを添える
+    """
+    prompt = f"""
+    以下の情報を元に、商品「{product_name}」の詳細ページの <{section}> セクションだけを作成してください。
     
-    for m_name in candidates:
+    ## 参考情報（競合サイト等）
+    {context_text}
+    """
+    metadata = (current_sections or {}).get("metadata")
+    if section != "metadata" and metadata:
+        prompt += f"""
+    ## 作成済みのメタデータ（タイトル・見出しと内容をそろえてください）
+    {metadata}
+    """
+    if section in SECTION_NOTES:
+        prompt += f"""
+    ## 追加指示
+    {SECTION_NOTES[section]}
+    """
+    return prompt
+
+def extract_section(text, section):
+    """
+    1セクション分の生成テキストからタグの中身を取り出す（タグが無い場合は全体を返す）
+    """
+    match = re.search(rf"<{section}>(.*?)</{section}>", text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    return re.sub(rf"</?{section}>", "", text).strip()
+
+def _usage(response):
+    """
+    SDKのusage_metadataからトークン数を取り出す
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None) or 0,
+        "response_tokens": getattr(usage, "candidates_token_count", None) or 0,
+    }
+
+def estimate_request_tokens(user_prompt, system_instruction=SYSTEM_INSTRUCTION):
+    """
+    1回の生成で消費するトークン数を見積もる（入力の概算 + 見込みの出力トークン数）
+    """
+    return context.estimate_tokens(system_instruction + user_prompt) + EXPECTED_RESPONSE_TOKENS
+
+def call_with_rate_limit(model, estimated_tokens, call, record=None):
+    """
+    レート制限の枠を確保してから call() を実行する
+
+    429 の場合は retry-after（無ければジッター付き指数バックオフ）だけ待って同じモデルで再試行し、
+    RATE_LIMIT_RETRIES 回を超えたら例外をそのまま送出する（呼び出し側で次のモデルに切り替える）。
+    枠が空くまでに MAX_RATE_LIMIT_WAIT 秒を超える場合（長い retry-after や TPM の枯渇）は、
+    待たずに TimeoutError を送出する（同じく次のモデルに切り替える）。
+    record に辞書を渡すと、待機秒数（"rate_limit_wait_sec"）と429の回数（"throttled"）を加算する。
+    """
+    limiter = ratelimit.get_rate_limiter()
+    record = record if record is not None else {}
+    record.setdefault("rate_limit_wait_sec", 0.0)
+    record.setdefault("throttled", 0)
+    for retry in range(RATE_LIMIT_RETRIES + 1):
+        record["rate_limit_wait_sec"] = round(
+            record["rate_limit_wait_sec"] + limiter.acquire(model, estimated_tokens, timeout=MAX_RATE_LIMIT_WAIT), 3
+        )
         try:
-            response = client.models.generate_content(
-                model=m_name,
-                contents=user_prompt,
-                config=types.GenerateContentConfig(
-                    system_instruction=SYSTEM_INSTRUCTION
-                )
-            )
-            return response.text
+            result = call()
         except Exception as e:
-            errors.append((m_name, str(e)))
+            if error_status(e) != 429:
+                raise
+            record["throttled"] += 1
+            if retry == RATE_LIMIT_RETRIES:
+                raise
+            # 待機は次の acquire で行う（他のスレッド・プロセスも同じモデルでは待たされる）
+            limiter.backoff(model, ratelimit.retry_after_seconds(e))
             continue
+        limiter.success(model)
+        return result
+
+def _settle_tokens(model, estimated_tokens, usage):
+    """
+    見積もりと実際のトークン数の差を TPM の枠に反映する
+    """
+    if usage:
+        actual = usage.get("prompt_tokens", 0) + usage.get("response_tokens", 0)
+        ratelimit.get_rate_limiter().adjust(model, actual - estimated_tokens)
+
+def generate_content_detailed(api_key, context_text, product_name, model_name=None, use_cache=True, refresh=False,
+                              structured=False):
+    """
+    Gemini API (google.genai) を呼び出してHTMLを生成し、付随情報と共に返す
+
+    戻り値: {"text": 生成テキスト, "model": 使用モデル, "cached": キャッシュから返したか,
+             "usage": トークン数, "retries": 失敗して次のモデルに切り替えた回数}
+    use_cache=False でキャッシュを使わない。refresh=True でキャッシュを無視して再生成し、結果で上書きする。
+    structured=True の場合、対応しているモデルには RESPONSE_SCHEMA に沿ったJSONで出力させる
+    （非対応のモデルに切り替わった場合はタグ形式。どちらも parse_generated_content で読み込める）。
+    """
+    with metrics.span("generate", structured=structured) as span:
+        user_prompt = build_user_prompt(context_text, product_name)
+        return _generate(api_key, SYSTEM_INSTRUCTION, user_prompt, model_name, use_cache, refresh, span,
+                         structured=structured)
+
+def _generate(api_key, system_instruction, user_prompt, model_name, use_cache, refresh, span, structured=False):
+    """
+    候補のモデルを順に試して生成する（generate_content_detailed などの共通処理）。結果は span にも記録する
+    """
+    candidates = candidate_models(model_name)
+
+    response_cache = cache.get_response_cache() if use_cache else None
+    cache_key = None
+    if response_cache:
+        cache_config = {"candidates": candidates}
+        if structured:
+            cache_config["structured"] = True
+        cache_key = response_cache.make_key(system_instruction, user_prompt, candidates[0], cache_config)
+        if not refresh:
+            cached = response_cache.get(cache_key)
+            if cached:
+                span.update({"model": cached["model"], "cached": True, "retries": 0})
+                return {"text": cached["text"], "model": cached["model"], "cached": True, "usage": {}, "retries": 0}
+
+    client = get_client(api_key)
+    estimated_tokens = estimate_request_tokens(user_prompt, system_instruction)
+
+    errors = []
+
+    for m_name in circuit_breaker.order(candidates):
+        use_schema = structured and supports_structured_output(m_name)
+        config = _generation_config(system_instruction, use_schema)
+        with metrics.span("generate.attempt", model=m_name) as attempt:
+            try:
+                response = call_with_rate_limit(
+                    m_name, estimated_tokens,
+                    lambda: client.models.generate_content(
+                        model=m_name,
+                        contents=user_prompt,
+                        config=config
+                    ),
+                    record=attempt,
+                )
+            except Exception as e:
+                circuit_breaker.record_failure(m_name, e)
+                attempt["error"] = str(e)[:500]
+                attempt["status"] = error_status(e)
+                errors.append((m_name, str(e)))
+                continue
+
+        circuit_breaker.record_success(m_name)
+        # キーは第1候補のモデルで作っているため、代替モデルの応答は保存しない
+        # （保存すると、第1候補が復旧した後も代替モデルの応答を返し続ける）
+        # スキーマに一致しない構造化出力も保存しない（保存すると再試行してもキャッシュから同じ応答が返る）
+        if response_cache and response.text and m_name == candidates[0] \
+                and not (use_schema and "error" in parse_structured_content(response.text)):
+            response_cache.put(cache_key, response.text, m_name)
+        usage = _usage(response)
+        _settle_tokens(m_name, estimated_tokens, usage)
+        span.update({"model": m_name, "cached": False, "retries": len(errors), **usage})
+        return {"text": response.text, "model": m_name, "cached": False, "usage": usage, "retries": len(errors)}
 
     # 全滅した場合
+    span.update({"error": "all models failed", "retries": len(errors)})
     error_details = "\\n".join([f"- {m}: {err}" for m, err in errors])
-    return f"Error: 生成に失敗しました。APIキーを確認してください。詳細:\\n{error_details}"
+    return {
+        "text": f"Error: 生成に失敗しました。APIキーを確認してください。詳細:\\n{error_details}",
+        "model": None,
+        "cached": False,
+        "usage": {},
+        "retries": len(errors),
+    }
+
+def generate_section(api_key, context_text, product_name, section, model_name=None, current_sections=None,
+                     use_cache=True, refresh=False):
+    """
+    ページ全体ではなく1つのセクション（metadata / html_content / reviews / references）だけを生成する
 
+    戻り値は generate_content_detailed と同じ形式で、"text" はタグを除いたセクションの内容
+    （失敗した場合は "Error:" で始まるメッセージ）、"section" はセクション名
+    """
+    with metrics.span("generate.section", section=section) as span:
+        system_instruction = build_section_instruction(section)
+        user_prompt = build_section_prompt(context_text, product_name, section, current_sections)
+        result = _generate(api_key, system_instruction, user_prompt, model_name, use_cache, refresh, span)
+    if not result["text"].startswith("Error:"):
+        result["text"] = extract_section(result["text"], section)
+    result["section"] = section
+    return result
+
+# 並列生成（fan-out）でセクションごとに使うモデル（None は呼び出し時に指定したモデル）
+# 本文は上位モデル、短いセクションは速くて安いモデルで生成する
+SECTION_MODELS = {
+    "metadata": "gemini-2.5-flash",
+    "html_content": None,
+    "reviews": "gemini-2.5-flash",
+    "references": "gemini-2.5-flash",
+}
+
+def generate_content_fanout(api_key, context_text, product_name, model_name=None, section_models=None,
+                            use_cache=True, refresh=False, on_section=None):
+    """
+    4つのセクションを別々のリクエストとして同時に生成し、1回分の生成結果として組み立てる
+
+    全体の待ち時間は最も遅いセクション（通常は本文）とほぼ同じになる。
+    section_models でセクションごとのモデルを指定できる（既定: SECTION_MODELS）。
+    on_section を渡すと、セクションが完成するたびに呼び出し元のスレッドで on_section(セクション名, 内容) を呼ぶ。
+
+    戻り値は generate_content_detailed と同じ形式に加えて、"sections"（セクションの辞書）と
+    "models"（セクションごとの使用モデル）を含む。いずれかのセクションが失敗した場合、
+    "text" は失敗したセクションを示す "Error:" で始まるメッセージになる
+    （成功したセクションはキャッシュされるため、やり直しでは失敗した分だけを生成する）
+    """
+    models = {**SECTION_MODELS, **(section_models or {})}
+    with metrics.span("generate.fanout") as span:
+        with ThreadPoolExecutor(max_workers=len(SECTION_KEYS)) as executor:
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, generate_section,
+                    api_key, context_text, product_name, key, models.get(key) or model_name,
+                    use_cache=use_cache, refresh=refresh,
+                ): key
+                for key in SECTION_KEYS
+            }
+            results = {}
+            for future in as_completed(futures):
+                key = futures[future]
+                results[key] = future.result()
+                if on_section and not results[key]["text"].startswith("Error:"):
+                    on_section(key, results[key]["text"])
+
+        sections = {key: "" if results[key]["text"].startswith("Error:") else results[key]["text"] for key in SECTION_KEYS}
+        usage = {}
+        for result in results.values():
+            for name, value in result["usage"].items():
+                usage[name] = usage.get(name, 0) + value
+        failed = [key for key in SECTION_KEYS if results[key]["text"].startswith("Error:")]
+        combined = {
+            "text": compose_generated_content(sections),
+            "sections": sections,
+            "model": results["html_content"]["model"],
+            "models": {key: results[key]["model"] for key in SECTION_KEYS},
+            "cached": all(r["cached"] for r in results.values()),
+            "usage": usage,
+            "retries": sum(r["retries"] for r in results.values()),
+        }
+        if failed:
+            details = "\\n".join(f"- {key}: {results[key]['text']}" for key in failed)
+            combined["text"] = f"Error: 一部のセクションの生成に失敗しました。詳細:\\n{details}"
+        span.update({"model": combined["model"], "cached": combined["cached"], "retries": combined["retries"], **usage})
+        if failed:
+            span["error"] = f"failed sections: {', '.join(failed)}"
+        return combined
+
+def generate_content(api_key, context_text, product_name, model_name=None, use_cache=True, refresh=False):
+    """
+    Gemini API (google.genai) を呼び出してHTMLを生成する
+    """
+    result = generate_content_detailed(
+        api_key, context_text, product_name, model_name, use_cache=use_cache, refresh=refresh
+    )
+    return result["text"]
+
+def generate_content_stream(api_key, context_text, product_name, model_name=None, use_cache=True, refresh=False, info=None):
+    """
+    Gemini API のストリーミング呼び出しで生成テキストをチャンクごとに返すジェネレーター
+
+    info に辞書を渡すと、終了時に使用モデル（"model"）、キャッシュ利用有無（"cached"）、
+    トークン数（"usage"）、モデルの切り替え回数（"retries"）、429 の回数（"throttled"）と
+    レート制限による待機秒数（"rate_limit_wait_sec"）が設定される。
+    最初のチャンクを受け取る前に失敗したモデルは次の候補に切り替える（429 は同じモデルで待って再試行する）。
+    生成が途中で中断された場合や全モデルが失敗した場合は "error" にその内容が入る（正常終了なら None）。
+    途中で中断された出力は不完全なため、呼び出し側は保存しないこと。
+    """
+    info = info if info is not None else {}
+    info.update({
+        "model": None, "cached": False, "usage": {}, "retries": 0, "throttled": 0, "rate_limit_wait_sec": 0.0,
+        "error": None,
+    })
+    started = time.time()
+    try:
+        yield from _generate_content_stream(api_key, context_text, product_name, model_name, use_cache, refresh, info)
+    finally:
+        # ジェネレーターは呼び出し側と交互に実行されるため、区間は終了時にまとめて記録する
+        metrics.record_span(
+            "generate.stream", started,
+            model=info["model"], cached=info["cached"], retries=info["retries"],
+            throttled=info["throttled"], rate_limit_wait_sec=info["rate_limit_wait_sec"], **info["usage"],
+            **({"error": info["error"][:500]} if info["error"] else {}),
+        )
 
+def _generate_content_stream(api_key, context_text, product_name, model_name, use_cache, refresh, info):
+    user_prompt = build_user_prompt(context_text, product_name)
+
+    candidates = candidate_models(model_name)
+
+    response_cache = cache.get_response_cache() if use_cache else None
+    cache_key = None
+    if response_cache:
+        cache_key = response_cache.make_key(
+            SYSTEM_INSTRUCTION, user_prompt, candidates[0], {"candidates": candidates}
+        )
+        if not refresh:
+            cached = response_cache.get(cache_key)
+            if cached:
+                info.update({"model": cached["model"], "cached": True})
+                yield cached["text"]
+                return
+
+    client = get_client(api_key)
+    estimated_tokens = estimate_request_tokens(user_prompt)
+
+    def open_stream(m_name):
+        # 429 などのエラーは最初のチャンクを受け取る時点で発生するため、そこまでを再試行の対象にする
+        stream = iter(client.models.generate_content_stream(
+            model=m_name,
+            contents=user_prompt,
+            config=_generation_config(SYSTEM_INSTRUCTION, False),
+        ))
+        first = next(stream, None)
+        return itertools.chain([first] if first is not None else [], stream)
+
+    errors = []
+
+    for m_name in circuit_breaker.order(candidates):
+        chunks = []
+        try:
+            stream = call_with_rate_limit(m_name, estimated_tokens, lambda: open_stream(m_name), record=info)
+            for chunk in stream:
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
+                # トークン数は最後のチャンクに含まれる
+                info["usage"] = _usage(chunk) or info["usage"]
+        except Exception as e:
+            circuit_breaker.record_failure(m_name, e)
+            info["retries"] += 1
+            if chunks:
+                # 途中まで出力済みの場合は切り替えられないため、そのまま終了する
+                info["model"] = m_name
+                info["error"] = f"生成が途中で中断されました ({m_name}: {e})"
+                yield f"\n\nError: {info['error']}"
+                return
+            errors.append((m_name, str(e)))
+            continue
+
+        circuit_breaker.record_success(m_name)
+        _settle_tokens(m_name, estimated_tokens, info["usage"])
+        info["model"] = m_name
+        # 代替モデルの応答は保存しない（_generate と同じ理由）
+        if response_cache and chunks and m_name == candidates[0]:
+            response_cache.put(cache_key, "".join(chunks), m_name)
+        return
+
+    # 全滅した場合
+    error_details = "\\n".join([f"- {m}: {err}" for m, err in errors])
+    info["error"] = "all models failed"
+    yield f"Error: 生成に失敗しました。APIキーを確認してください。詳細:\\n{error_details}"
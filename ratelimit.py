@@ -0,0 +1,206 @@
+"""
+Gemini API のリクエスト数・トークン数のレート制限（トークンバケット）
+
+スレッド間だけでなく一括生成の複数プロセスやStreamlitアプリとも共有できるよう、
+バケットの状態は SQLite（cache.CACHE_DIR/ratelimit.sqlite3）に保存する。
+
+- モデルごとに RPM（1分あたりリクエスト数）と TPM（1分あたりトークン数）の2つのバケットを持つ
+- 429 を受けたら、そのモデルの全リクエストを待機させる（retry-after があればその秒数、
+  無ければジッター付き指数バックオフ）
+- 上限値は RATE_LIMITS か環境変数 LPGEN_RATE_LIMITS（JSON）で設定する
+  例: LPGEN_RATE_LIMITS='{"gemini-2.5-flash": {"rpm": 1000, "tpm": 1000000}}'
+"""
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+import cache
+
+# モデルごとの上限（未指定のモデルは DEFAULT_LIMIT）
+DEFAULT_LIMIT = {"rpm": 60, "tpm": 1000000}
+RATE_LIMITS = {
+    "gemini-3-pro-preview": {"rpm": 25, "tpm": 1000000},
+    "gemini-1.5-pro": {"rpm": 25, "tpm": 1000000},
+}
+RATE_LIMITS.update(json.loads(os.getenv("LPGEN_RATE_LIMITS", "{}")))
+
+# 429 のバックオフ設定（秒）
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    model TEXT PRIMARY KEY,
+    until REAL NOT NULL,
+    failures INTEGER NOT NULL
+);
+"""
+
+def limits_for(model):
+    return RATE_LIMITS.get(model, DEFAULT_LIMIT)
+
+def retry_after_seconds(error):
+    """
+    429 の例外から再試行までの秒数を取り出す（Retry-After ヘッダー / RetryInfo.retryDelay）
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    # google.rpc.RetryInfo の "retryDelay": "32s" 形式
+    match = re.search(r"retryDelay['\"]?\s*[:=]\s*['\"]?([\d.]+)s", str(getattr(error, "details", None) or error))
+    if match:
+        return float(match.group(1))
+    return None
+
+class RateLimiter:
+    """
+    SQLite に状態を保存する、プロセス間共有のトークンバケット
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache.CACHE_DIR, "ratelimit.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _take(self, conn, key, cost, capacity, now):
+        """
+        バケットから cost を取り出す。足りなければ不足分が貯まるまでの秒数を返す
+        """
+        rate = capacity / 60.0
+        row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+        # 1回で上限を超える要求は、満タンになれば通す
+        needed = min(cost, capacity)
+        if tokens >= needed:
+            return tokens - cost, 0.0
+        return tokens, (needed - tokens) / rate
+
+    def acquire(self, model, tokens=0, timeout=None):
+        """
+        model に1リクエスト・tokens トークン分の枠ができるまで待つ。待った秒数を返す
+        """
+        limit = limits_for(model)
+        started = time.time()
+        conn = self._connect()
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                block = conn.execute("SELECT until FROM blocks WHERE model = ?", (model,)).fetchone()
+                wait = max(0.0, block[0] - now) if block else 0.0
+                if not wait:
+                    rpm_tokens, rpm_wait = self._take(conn, f"{model}:rpm", 1, limit["rpm"], now)
+                    tpm_tokens, tpm_wait = self._take(conn, f"{model}:tpm", tokens, limit["tpm"], now)
+                    wait = max(rpm_wait, tpm_wait)
+                    if not wait:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                            [(f"{model}:rpm", rpm_tokens, now), (f"{model}:tpm", tpm_tokens, now)],
+                        )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if not wait:
+                return time.time() - started
+            if timeout is not None and time.time() - started + wait > timeout:
+                raise TimeoutError(f"rate limit wait for {model} exceeded {timeout}s")
+            # 他のプロセスと同時に再開しないよう少し揺らす
+            time.sleep(wait + random.uniform(0, 0.05))
+
+    def adjust(self, model, tokens):
+        """
+        実際の使用トークン数との差（tokens）を TPM バケットに反映する（正なら追加で消費）
+        """
+        if not tokens:
+            return
+        limit = limits_for(model)
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens_left, _ = self._take(conn, f"{model}:tpm", 0, limit["tpm"], now)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                (f"{model}:tpm", tokens_left - tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def backoff(self, model, retry_after=None):
+        """
+        429 を受けたモデルを一定時間ブロックし、待機秒数を返す
+
+        retry_after が無ければ連続失敗回数に応じたジッター付き指数バックオフ（full jitter）
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT until, failures FROM blocks WHERE model = ?", (model,)).fetchone()
+            failures = (row[1] if row else 0) + 1
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, 1.0)
+            else:
+                delay = random.uniform(BACKOFF_BASE / 2, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1)))
+            until = max(now + delay, row[0] if row else 0.0)
+            conn.execute(
+                "INSERT OR REPLACE INTO blocks (model, until, failures) VALUES (?, ?, ?)",
+                (model, until, failures),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return until - now
+
+    def success(self, model):
+        """
+        成功したらバックオフの連続失敗回数をリセットする
+        """
+        conn = self._connect()
+        conn.execute("UPDATE blocks SET failures = 0 WHERE model = ? AND failures > 0", (model,))
+
+    def reset(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM buckets")
+        conn.execute("DELETE FROM blocks")
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    """
+    プロセス内で共有するレートリミッターを返す
+    """
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
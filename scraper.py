@@ -1,6 +1,82 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from bs4.dammit import UnicodeDammit
 import re
+import hashlib
+import threading
+import contextvars
+import unicodedata
+import cache
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # lxml が無い環境では html.parser で処理する
+    lxml = None
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# 同時接続数の設定
+MAX_WORKERS = 8     # 全体の同時取得数
+PER_HOST_LIMIT = 2  # 同一ホストへの同時接続数
+
+# 抽出の上限
+MAX_DOWNLOAD_BYTES = 2 * 1024 * 1024  # これ以上はダウンロードしない
+MAX_CONTENT_CHARS = 10000             # 本文の文字数制限（トークン節約のため）
+
+# 本文から除外するタグ
+NOISE_TAGS = ["script", "style", "noscript", "nav", "footer", "header"]
+# 本文エリアの候補（上から順に探し、十分なテキストがあればそこだけを使う）
+# - ページ全体を囲む main / #main などを先に探す
+# - article はレビューや関連記事ごとに複数並ぶことがあるため、ページに1つだけの場合に限って使う
+MAIN_CONTENT_SELECTORS = ["main", "[role=main]", "#main", "#content", "article", ".main", ".content"]
+# 同じ候補の lxml 用 XPath 表現
+MAIN_CONTENT_XPATHS = [
+    "//main",
+    "//*[@role='main']",
+    "//*[@id='main']",
+    "//*[@id='content']",
+    "//article",
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' main ')]",
+    "//*[contains(concat(' ', normalize-space(@class), ' '), ' content ')]",
+]
+MIN_MAIN_CONTENT_CHARS = 200
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphores = {}
+_host_lock = threading.Lock()
+
+def get_session():
+    """
+    Keep-Aliveで接続を使い回す共有セッションを返す
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(HEADERS)
+            _session = session
+        return _session
+
+def _host_semaphore(url):
+    """
+    ホストごとの同時接続数を制限するセマフォを返す
+    """
+    host = urlparse(url).netloc.lower()
+    with _host_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+        return _host_semaphores[host]
 
 def clean_text(text):
     """
@@ -9,48 +85,204 @@ def clean_text(text):
     text = re.sub(r'\s+', ' ', text)
     return text.strip()
 
-def scrape_web_page(url):
+def _collect_text(strings, limit):
     """
-    指定されたURLからタイトルと本文テキストを取得する
+    テキスト片を空白を整形しながら連結し、limit 文字に達した時点で打ち切る
     """
+    parts = []
+    total = 0
+    for piece in strings:
+        piece = clean_text(piece)
+        if not piece:
+            continue
+        parts.append(piece)
+        total += len(piece) + 1
+        if total >= limit:
+            break
+    return " ".join(parts)[:limit]
+
+def _find_main_content_lxml(root):
+    for xpath in MAIN_CONTENT_XPATHS:
+        nodes = root.xpath(xpath)
+        if xpath == "//article" and len(nodes) > 1:
+            continue
+        for node in nodes:
+            if len(_collect_text(node.itertext(), MIN_MAIN_CONTENT_CHARS)) >= MIN_MAIN_CONTENT_CHARS:
+                return node
+    body = root.find(".//body")
+    return body if body is not None else root
+
+def _extract_page_lxml(html, limit):
+    if isinstance(html, bytes):
+        html = UnicodeDammit(html, is_html=True).unicode_markup or ""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # 不要なタグ（スクリプトやスタイル）を削除
-        for script in soup(["script", "style", "nav", "footer", "header"]):
-            script.extract()
-            
-        title = soup.title.string if soup.title else "No Title"
-        # bodyなどの主要なテキストを取得
-        text = soup.get_text()
-        
-        cleaned_text = clean_text(text)
-        
-        return {
-            "url": url,
-            "title": title,
-            "content": cleaned_text[:10000] # 文字数制限（トークン節約のため一旦10000文字）
-        }
-    except Exception as e:
-        return {
-            "url": url,
-            "error": str(e)
-        }
-
-def scrape_multiple_urls(urls):
+        root = lxml.html.document_fromstring(html)
+    except ValueError:
+        # XML宣言付きの文字列は lxml が受け付けないためバイト列で渡す
+        root = lxml.html.document_fromstring(html.encode("utf-8"))
+    except etree.ParserError:
+        return "No Title", ""
+
+    title_node = root.find(".//title")
+    title = clean_text(title_node.text_content()) if title_node is not None else ""
+
+    etree.strip_elements(root, *NOISE_TAGS, with_tail=False)
+    etree.strip_elements(root, etree.Comment, with_tail=False)
+    content_root = _find_main_content_lxml(root)
+    return title or "No Title", _collect_text(content_root.itertext(), limit)
+
+def _extract_page_bs4(html, limit):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # 不要なタグ（スクリプトやスタイル）を削除
+    for script in soup(NOISE_TAGS):
+        script.extract()
+
+    title = clean_text(soup.title.get_text()) if soup.title else ""
+
+    content_root = soup.body or soup
+    for selector in MAIN_CONTENT_SELECTORS:
+        if selector == "article" and len(soup.select(selector, limit=2)) > 1:
+            continue
+        node = soup.select_one(selector)
+        if node and len(_collect_text(node.stripped_strings, MIN_MAIN_CONTENT_CHARS)) >= MIN_MAIN_CONTENT_CHARS:
+            content_root = node
+            break
+
+    return title or "No Title", _collect_text(content_root.stripped_strings, limit)
+
+def extract_page(html, limit=MAX_CONTENT_CHARS):
+    """
+    HTMLからタイトルと本文テキストを抽出する
+
+    main / article などの本文エリアがあればそこだけを対象とし（article が複数あれば本文エリアとみなさない）、
+    limit 文字に達した時点で走査を打ち切る。lxml があれば lxml で解析する
+    """
+    if not html:
+        return "No Title", ""
+    if lxml is not None:
+        return _extract_page_lxml(html, limit)
+    return _extract_page_bs4(html, limit)
+
+def content_hash(title, content):
+    """
+    タイトルと本文の正規化済みハッシュ（NFKC・空白の違いは無視する）。ページが変わったかどうかの判定に使う
+    """
+    normalized = unicodedata.normalize("NFKC", f"{title}\n{content}")
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def read_limited(response, max_bytes=MAX_DOWNLOAD_BYTES):
+    """
+    レスポンス本文を最大 max_bytes まで読み込む（超えた分はダウンロードしない）
+    """
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            break
+    response.close()
+    return b"".join(chunks)[:max_bytes]
+
+def scrape_web_page(url, session=None, use_cache=True, revalidate=False):
+    """
+    指定されたURLからタイトルと本文テキストを取得する
+
+    use_cache=True の場合はディスクキャッシュを利用し、期限切れのページは
+    ETag / Last-Modified で再検証する（304なら再ダウンロード・再解析しない）。
+    revalidate=True の場合は期限内のページも再検証する。
+    結果には本文の変更検知用に content_hash を含める。
+    """
+    with metrics.span("scrape.page", url=url) as span:
+        try:
+            page_cache = cache.get_page_cache() if use_cache else None
+            entry = page_cache.get(url) if page_cache else None
+            if entry and entry["fresh"] and not revalidate:
+                page_cache.hit(url)
+                span["cache"] = "hit"
+                return _page_result(url, entry["title"], entry["content"])
+
+            session = session or get_session()
+            headers = page_cache.conditional_headers(entry) if page_cache else {}
+            with metrics.span("scrape.fetch", url=url) as fetch_span:
+                with _host_semaphore(url):
+                    response = session.get(url, headers=headers, timeout=10, stream=True)
+                    fetch_span["status"] = response.status_code
+
+                    if response.status_code == 304 and entry:
+                        response.close()
+                        page_cache.revalidated(url)
+                        span["cache"] = "revalidated"
+                        return _page_result(url, entry["title"], entry["content"])
+
+                    if not response.ok:
+                        response.close()
+                    response.raise_for_status()
+                    body = read_limited(response)
+                    fetch_span["bytes"] = len(body)
+
+            span["cache"] = "miss" if page_cache else "disabled"
+            with metrics.span("scrape.parse", url=url):
+                title, content = extract_page(body)
+
+            if page_cache:
+                page_cache.put(
+                    url, title, content,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                )
+
+            return _page_result(url, title, content)
+        except Exception as e:
+            span["error"] = str(e)[:500]
+            return {
+                "url": url,
+                "error": str(e)
+            }
+
+def _page_result(url, title, content):
+    return {
+        "url": url,
+        "title": title,
+        "content": content,
+        "content_hash": content_hash(title, content),
+    }
+
+def scrape_multiple_urls(urls, deadline=None, max_workers=MAX_WORKERS, use_cache=True, revalidate=False):
     """
     複数のURLをリストまたは改行区切りテキストで受け取り、結果をリストで返す
+
+    各URLは並列に取得し、結果は入力と同じ順序で返す。
+    deadline（秒）を指定した場合、期限までに終わらなかったURLはエラーとして返す。
     """
     if isinstance(urls, str):
         urls = [u.strip() for u in urls.split('\n') if u.strip()]
-    
+
+    if not urls:
+        return []
+
+    with metrics.span("scrape.multiple", urls=len(urls)) as span:
+        session = get_session()
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(urls)))
+        # 計測中の run を各スレッドに引き継ぐ
+        futures = [
+            executor.submit(contextvars.copy_context().run, scrape_web_page, url, session, use_cache, revalidate)
+            for url in urls
+        ]
+        wait(futures, timeout=deadline)
+        # 期限切れのタスクは待たずに打ち切る
+        executor.shutdown(wait=False, cancel_futures=True)
+        span["timed_out"] = sum(1 for f in futures if not f.done() or f.cancelled())
+
     results = []
-    for url in urls:
-        results.append(scrape_web_page(url))
+    for url, future in zip(urls, futures):
+        if future.done() and not future.cancelled():
+            results.append(future.result())
+        else:
+            results.append({
+                "url": url,
+                "error": f"Timeout: {deadline}秒以内に取得できませんでした"
+            })
     return results